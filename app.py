@@ -1,28 +1,65 @@
+import asyncio
 import logging
 
-from aiogram import executor
-import asyncio
+# Процессы пула (spawn) заново импортируют этот модуль как __mp_main__:
+# хук замеров, бот, обработчики и базы нужны только основному процессу
+if __name__ == '__main__':
+    from startup import startup_report
+    startup_report.install()
 
-# from database import database
-from handlers import user
-from loader import bot, dp, ADMIN_ID
-from database.database import moex_db, update_data_periodically, isins
+    from aiogram import executor
+
+    # from database import database
+    from handlers import user
+    from handlers.user import risk_stats
+    from config import BOT_MODE, METRICS_PORT, WEBAPP_HOST
+    from loader import bot, dp, ADMIN_ID
+    from database.database import moex_db, user_db, update_data_periodically
+    from database.iss import iss_client
+    from model import model
+    from model.compute import compute_service
+    from model.backtest import refresh_backtest
+    from webhook import start_webhook
+    from metrics import start_metrics_server
 
 logging.basicConfig(level=logging.INFO)
 
 
 async def on_startup(dispatcher):
     await bot.send_message(chat_id=ADMIN_ID, text='Бот запущен!')
-    await moex_db.update_moex_data(isins)
+    with startup_report.stage('compute pool'):
+        compute_service.start()
+    # None - для пользователей, у которых уровень риска не выбран в текущем диалоге
+    target_risks = [None, *risk_stats.values()]
+    moex_db.refresh_listeners.append(
+        lambda version: model.warm_up(version, target_risks))
+    moex_db.refresh_listeners.append(
+        lambda version: refresh_backtest(version, risk_stats))
+
+    # Отвечаем по последним сохранённым данным, обновление идёт в фоне
+    if moex_db.data_version:
+        asyncio.create_task(model.warm_up(moex_db.data_version, target_risks))
+        asyncio.create_task(refresh_backtest(moex_db.data_version, risk_stats))
     asyncio.create_task(update_data_periodically())
+    if BOT_MODE != 'webhook' and METRICS_PORT:
+        await start_metrics_server(WEBAPP_HOST, int(METRICS_PORT))
+
+    startup_report.finish()
+    logging.info(startup_report.format())
 
 
 async def on_shutdown(dp):
     await bot.send_message(chat_id=ADMIN_ID, text='Бот выключен!')
+    compute_service.shutdown()
+    await user_db.close()
+    await iss_client.close()
 
 
 if __name__ == '__main__':
-    executor.start_polling(dp,
-                           on_startup=on_startup,
-                           on_shutdown=on_shutdown,
-                           skip_updates=True)
+    if BOT_MODE == 'webhook':
+        start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        executor.start_polling(dp,
+                               on_startup=on_startup,
+                               on_shutdown=on_shutdown,
+                               skip_updates=True)
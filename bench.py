@@ -0,0 +1,202 @@
+"""
+Offline benchmark of the data-to-portfolio pipeline.
+
+Builds synthetic price/volume panels, stores them in a temporary SQLite
+database and times every stage separately. Each measurement is printed as
+one JSON line, so runs can be compared and plotted:
+
+    python bench.py --assets 20 200 2000 --years 1 5 10 --repeat 3 --output bench.jsonl
+
+The bot's modules open their databases (moex_data.db, users.db, ...) by
+relative path when imported, so the benchmark runs in a temporary directory
+with a copy of the fund registry and never touches the checkout's databases.
+Every stage runs --warmup discarded times before it is measured, so lazy
+imports and first-call caches do not end up in the timings.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+STAGES = ('store_candles', 'load_panels', 'check_and_clean_data', 'compute_cov_matrix', 'ewm_rebuild',
+          'ewm_update', 'liquidity_levels',
+          'compute_mu_black_litterman', 'build_artifacts', 'optimize_risk', 'optimize_return',
+          'optimize_liquidity', 'simulate_normal', 'simulate_bootstrap', 'render_chart')
+TRADING_DAYS = 252
+REGISTRY_FILES = ('etf_data.xlsx', 'etf_market.xlsx')
+
+
+def synthetic_candles(assets, days, seed=0):
+    """
+    One-factor daily candles with random gaps.
+
+    :param assets: int, number of funds
+    :param days: int, number of trading days
+    :param seed: int, random seed
+    :return: dict, ISIN -> pd.DataFrame with open, high, low, close, volume columns
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2015-01-01', periods=days)
+    beta = rng.uniform(0.3, 1.2, assets)
+    market = rng.normal(0.0003, 0.01, (days, 1))
+    returns = market * beta + rng.normal(0.0001, 0.008, (days, assets))
+    close = 100 * np.exp(np.cumsum(returns, axis=0))
+    volume = rng.lognormal(8, 1.5, (days, assets)).round()
+    # Часть дней без сделок, как у малоликвидных фондов
+    traded = rng.random((days, assets)) > rng.uniform(0, 0.3, assets)
+    traded[0] = True
+
+    candles = {}
+    for i in range(assets):
+        rows = traded[:, i]
+        candles[f"BENCH{i:07d}"] = pd.DataFrame({
+            'open': close[rows, i], 'high': close[rows, i] * 1.01, 'low': close[rows, i] * 0.99,
+            'close': close[rows, i], 'volume': volume[rows, i],
+        }, index=dates[rows])
+    return candles
+
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return result, timings
+
+
+def run(assets, days, repeat, warmup, stages, emit):
+    from config import EWM_HALFLIFE
+    from database.covariance import EWMCovariance
+    from database.database import MoexDatabase
+    from handlers.charts import PORTFOLIO_FIGSIZE, _render_pie_chart
+    from model import model
+    from model.simulation import simulate
+
+    def record(stage, fn, repeat=repeat):
+        if stage not in stages:
+            return fn()
+        result, timings = measure(fn, repeat, warmup)
+        emit({'assets': assets, 'days': days, 'stage': stage, 'repeat': len(timings), 'warmup': warmup,
+              'min': min(timings), 'median': statistics.median(timings), 'mean': statistics.fmean(timings)})
+        return result
+
+    candles = synthetic_candles(assets, days)
+    with tempfile.TemporaryDirectory() as directory:
+        db = MoexDatabase(os.path.join(directory, 'bench.db'), name='Benchmark')
+        db.create_database()
+
+        def store():
+            for isin, frame in candles.items():
+                db.save_candles(isin, frame)
+            db.base.commit()
+
+        # Повторная запись — это upsert тех же строк, поэтому её тоже можно мерить повторно
+        record('store_candles', store)
+        db.cursor.execute("UPDATE moex_meta SET value = value + 1 WHERE key = 'data_version'")
+        db.base.commit()
+        db.load_data_version()
+
+        def load():
+            db.panel_cache.invalidate()
+            return db.get_panels()
+
+        open_prices, close_prices, volumes = record('load_panels', load)
+        raw_close = db.read_candles()[1]
+        db.close()
+
+    record('check_and_clean_data', lambda: model.check_and_clean_data(raw_close))
+    cov_matrix = record('compute_cov_matrix', lambda: model.compute_cov_matrix(close_prices))
+
+    def rebuild():
+        state = EWMCovariance(EWM_HALFLIFE)
+        state.consume(close_prices)
+        return state
+
+    # Полный проход по истории против одного нового дневного бара
+    state = record('ewm_rebuild', rebuild)
+    last_bar = close_prices.to_numpy(dtype=float)[-1]
+    record('ewm_update', lambda: state.update(last_bar))
+    record('liquidity_levels', lambda: model.get_liquidity_levels(close_prices, volumes))
+
+    weights = np.full(assets, 1 / assets)
+    mu_market = model.compute_mu_market(cov_matrix, weights, delta=2.5)
+    record('compute_mu_black_litterman', lambda: model.compute_mu_black_litterman(
+        mu_market, cov_matrix, np.identity(assets), weights, 0.05))
+
+    artifacts = record('build_artifacts', lambda: model.build_artifacts(close_prices, volumes))
+    # Синтетических фондов нет в реестре, поэтому рыночные веса берутся равными
+    artifacts['mu_market'] = model.compute_mu_market(artifacts['cov_matrix'], weights, delta=2.5)
+    metric = model.LIQUIDITY_METRICS[0]
+    stats, _ = record('optimize_risk', lambda: model.black_litterman_optimization(
+        close_prices, metric, 'risk', artifacts=artifacts))
+    mu, cov = model.black_litterman_inputs(artifacts, metric, assets)
+    stats_weights = np.array(list(stats['weights'].values()))
+    target_return = float(np.mean([stats['expected_return'], np.max(mu)]))
+    record('optimize_return', lambda: model.black_litterman_optimization(
+        close_prices, metric, 'return', target_return=target_return, artifacts=artifacts))
+    record('optimize_liquidity', lambda: model.black_litterman_optimization(
+        close_prices, model.LIQUIDITY_METRICS[-1], 'liquidity', artifacts=artifacts))
+    history = close_prices.pct_change().iloc[1:].fillna(0).to_numpy()
+    for method in ('normal', 'bootstrap'):
+        record(f'simulate_{method}', lambda: simulate(stats_weights, mu, artifacts['cov_matrix'], method=method,
+                                                      history=history))
+    record('render_chart', lambda: _render_pie_chart(stats['weights'], PORTFOLIO_FIGSIZE))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--assets', type=int, nargs='+', default=[20, 200])
+    parser.add_argument('--years', type=float, nargs='+', default=[1, 5])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1, help='discarded runs of every stage before timing')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--output', help='file to append JSON lines to, stdout by default')
+    args = parser.parse_args(argv)
+
+    # handlers создаёт Bot при импорте; в Telegram бенчмарк не обращается
+    os.environ.setdefault('API_TOKEN', '123456:offline-benchmark')
+    output = open(args.output, 'a') if args.output else sys.stdout
+
+    # Относительные пути баз бота указывают во временный каталог
+    root = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, root)
+    workdir = tempfile.TemporaryDirectory()
+    for name in REGISTRY_FILES:
+        shutil.copy(os.path.join(root, name), workdir.name)
+    cwd = os.getcwd()
+    os.chdir(workdir.name)
+
+    def emit(row):
+        output.write(json.dumps(row) + '\n')
+        output.flush()
+
+    emit({'stage': 'meta', 'python': platform.python_version(), 'numpy': np.__version__,
+          'pandas': pd.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+          'started': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    try:
+        # Сообщения модулей (подключение баз и т.п.) не должны смешиваться с JSON в stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            for assets in args.assets:
+                for years in args.years:
+                    run(assets, int(years * TRADING_DAYS), args.repeat, args.warmup, set(args.stages), emit)
+    finally:
+        os.chdir(cwd)
+        workdir.cleanup()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+from os import getenv
+
+from dotenv import load_dotenv
+
+load_dotenv()
+API_TOKEN = getenv("API_TOKEN")
+ADMIN_ID = getenv("ADMIN_ID")
+
+# Пул процессов для оптимизации портфеля
+COMPUTE_WORKERS = int(getenv("COMPUTE_WORKERS", 2))
+COMPUTE_MAX_JOBS = int(getenv("COMPUTE_MAX_JOBS", 4))
+COMPUTE_TIMEOUT = float(getenv("COMPUTE_TIMEOUT", 60))
+# pool — пул процессов внутри бота, broker — отдельные процессы worker.py через очередь в SQLite
+COMPUTE_BACKEND = getenv("COMPUTE_BACKEND", "pool")
+BROKER_DB_PATH = getenv("BROKER_DB_PATH", "broker.db")
+BROKER_POLL_INTERVAL = float(getenv("BROKER_POLL_INTERVAL", 0.02))  # секунды
+BROKER_POLL_MAX = float(getenv("BROKER_POLL_MAX", 0.5))  # предел интервала опроса при долгих заданиях
+BROKER_LEASE = float(getenv("BROKER_LEASE", 30))  # секунды без heartbeat, после которых задание забирает другой процесс
+BROKER_MAX_ATTEMPTS = int(getenv("BROKER_MAX_ATTEMPTS", 3))  # запусков задания, после которых оно считается упавшим
+
+# Кэш готовых портфелей
+RESULT_CACHE_SIZE = int(getenv("RESULT_CACHE_SIZE", 256))
+TARGET_RETURN_STEP = float(getenv("TARGET_RETURN_STEP", 0.005))
+
+# Сетка эффективной границы для запросов по доходности
+FRONTIER_POINTS = int(getenv("FRONTIER_POINTS", 25))
+FRONTIER_TOLERANCE = float(getenv("FRONTIER_TOLERANCE", 0.0005))
+
+# Кэш диаграмм портфелей
+CHART_CACHE_SIZE = int(getenv("CHART_CACHE_SIZE", 128))
+
+# Пул соединений базы пользователей
+USER_DB_POOL_SIZE = int(getenv("USER_DB_POOL_SIZE", 4))
+USER_DB_COMMIT_WINDOW = float(getenv("USER_DB_COMMIT_WINDOW", 0.05))
+
+# Хранилище состояний диалогов
+FSM_STORAGE_PATH = getenv("FSM_STORAGE_PATH", "users.db")
+FSM_CACHE_SIZE = int(getenv("FSM_CACHE_SIZE", 1000))
+FSM_FLUSH_INTERVAL = float(getenv("FSM_FLUSH_INTERVAL", 1))
+FSM_TTL = float(getenv("FSM_TTL", 7 * 24 * 3600))
+
+# Очередь расчётов портфелей
+QUEUE_WORKERS = int(getenv("QUEUE_WORKERS", COMPUTE_MAX_JOBS))
+QUEUE_MAX_DEPTH = int(getenv("QUEUE_MAX_DEPTH", 50))
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = getenv("BOT_MODE", "polling")
+WEBHOOK_URL = getenv("WEBHOOK_URL")  # внешний адрес; без него вебхук не регистрируется
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(getenv("WEBAPP_PORT", 8080))
+WEBHOOK_CONCURRENCY = int(getenv("WEBHOOK_CONCURRENCY", 32))
+WEBHOOK_DRAIN_TIMEOUT = float(getenv("WEBHOOK_DRAIN_TIMEOUT", 60))
+# Порт /metrics в режиме polling; в режиме webhook метрики отдаёт тот же сервер
+METRICS_PORT = getenv("METRICS_PORT")
+
+# Клиент MOEX ISS
+ISS_BASE_URL = getenv("ISS_BASE_URL", "https://iss.moex.com/iss")
+ISS_CONCURRENCY = int(getenv("ISS_CONCURRENCY", 8))
+ISS_TIMEOUT = float(getenv("ISS_TIMEOUT", 30))
+ISS_RETRIES = int(getenv("ISS_RETRIES", 3))
+ISS_BACKOFF = float(getenv("ISS_BACKOFF", 0.5))
+ISS_BREAKER_THRESHOLD = int(getenv("ISS_BREAKER_THRESHOLD", 5))
+ISS_BREAKER_RESET = float(getenv("ISS_BREAKER_RESET", 300))
+
+# Хранилище сделок MOEX (model/trades_loader_repo2.py)
+TRADES_DB_PATH = getenv("TRADES_DB_PATH", "trades.db")
+
+# Метрики ликвидности
+LIQUIDITY_WINDOW = int(getenv("LIQUIDITY_WINDOW", 63))  # торговых дней
+LIQUIDITY_POSITION = float(getenv("LIQUIDITY_POSITION", 1_000_000))  # руб., для времени продажи
+LIQUIDITY_PENALTY = float(getenv("LIQUIDITY_PENALTY", 0.1))  # доля средней дисперсии для фонда со средней ликвидностью
+
+# Оценка ковариации: ledoit_wolf пересчитывает её по всей истории,
+# ewm обновляет экспоненциально взвешенную оценку по новым свечам
+COV_ESTIMATOR = getenv("COV_ESTIMATOR", "ledoit_wolf")
+EWM_HALFLIFE = float(getenv("EWM_HALFLIFE", 63))  # торговых дней
+EWM_SHRINKAGE = float(getenv("EWM_SHRINKAGE", 0.1))  # 0 — без сжатия
+
+# Бэктест оптимизатора после каждого обновления данных
+BACKTEST_WINDOW = int(getenv("BACKTEST_WINDOW", 126))  # торговых дней в окне оценки
+BACKTEST_REBALANCE = int(getenv("BACKTEST_REBALANCE", 21))  # дней между ребалансировками
+BACKTEST_SHRINKAGE = float(getenv("BACKTEST_SHRINKAGE", 0.1))
+
+# Моделирование исходов портфеля методом Монте-Карло
+SIMULATION_METHOD = getenv("SIMULATION_METHOD", "normal")  # normal или bootstrap
+SIMULATION_PATHS = int(getenv("SIMULATION_PATHS", 20000))
+SIMULATION_HORIZON = int(getenv("SIMULATION_HORIZON", 252))  # торговых дней
+SIMULATION_MEMORY_MB = float(getenv("SIMULATION_MEMORY_MB", 32))  # память на одну порцию путей
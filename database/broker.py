@@ -0,0 +1,155 @@
+import logging
+import pickle
+import sqlite3
+import time
+
+from config import BROKER_DB_PATH, BROKER_LEASE, BROKER_MAX_ATTEMPTS
+
+
+class JobBroker:
+    """
+    SQLite job table shared by the bot and standalone compute workers (worker.py).
+
+    The bot inserts pickled jobs, a worker claims the oldest queued one in
+    an IMMEDIATE transaction, so every job goes to exactly one worker, and
+    writes the pickled result back into the same row. The bot collects
+    finished rows by id and deletes them. Rows are only data: a job whose
+    caller has given up is deleted, and a worker finishing it later updates
+    nothing.
+
+    A claim is a lease: the worker renews the row's heartbeat while it runs
+    the job, and a running job whose heartbeat is older than `lease` seconds
+    (its worker crashed or hung) is claimed again by the next free worker.
+    A job whose lease has expired after max_attempts claims is taken to kill
+    its workers (OOM, a crash in the solver) and is failed instead of being
+    handed to the next one.
+    """
+
+    def __init__(self, filename=BROKER_DB_PATH, lease=BROKER_LEASE, max_attempts=BROKER_MAX_ATTEMPTS):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # autocommit: транзакции открываются явно в claim
+        self.connection = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS broker_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            payload BLOB,
+            result BLOB,
+            worker TEXT,
+            submitted REAL,
+            started REAL,
+            finished REAL,
+            heartbeat REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )""")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(broker_jobs)")]
+        for column, definition in (('heartbeat', 'REAL'), ('attempts', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE broker_jobs ADD COLUMN {column} {definition}")
+        self.connection.execute("""
+        CREATE INDEX IF NOT EXISTS broker_jobs_status ON broker_jobs (status, id)
+        """)
+
+    def submit(self, payload):
+        """
+        Queue a job.
+
+        :param payload: bytes, pickled job
+        :return: int, job id
+        """
+        cursor = self.connection.execute(
+            "INSERT INTO broker_jobs (payload, submitted) VALUES (?, ?)", (payload, time.time()))
+        return cursor.lastrowid
+
+    def claim(self, worker):
+        """
+        Take the oldest queued job, or a running one whose lease has expired.
+
+        :param worker: str, name of the claiming worker
+        :return: tuple, job id and payload, or None if the queue is empty
+        """
+        claimable = """
+        SELECT id, payload, attempts FROM broker_jobs
+        WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?)
+        ORDER BY id LIMIT 1
+        """
+        # Пустая очередь проверяется без блокировки на запись
+        if self.connection.execute(claimable, (time.time() - self.lease,)).fetchone() is None:
+            return None
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            while True:
+                row = self.connection.execute(claimable, (now - self.lease,)).fetchone()
+                if row is None:
+                    break
+                job_id, payload, attempts = row
+                if attempts < self.max_attempts:
+                    self.connection.execute("""
+                    UPDATE broker_jobs SET status = 'running', worker = ?, started = ?, heartbeat = ?,
+                        attempts = attempts + 1
+                    WHERE id = ?""", (worker, now, now, job_id))
+                    break
+                # Задание, которое раз за разом убивает исполнителя, больше никому не выдаётся
+                logging.warning(f"Job {job_id} lost its worker {attempts} times, giving up")
+                error = RuntimeError(f"Compute job lost its worker {attempts} times")
+                self.connection.execute(
+                    "UPDATE broker_jobs SET status = 'failed', result = ?, finished = ? WHERE id = ?",
+                    (pickle.dumps(error), now, job_id))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return None if row is None else (job_id, payload)
+
+    def heartbeat(self, job_id, worker):
+        """Renew the lease of a job the worker is still running."""
+        self.connection.execute(
+            "UPDATE broker_jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time(), job_id, worker))
+
+    def finish(self, job_id, worker, status, result):
+        """
+        Store the outcome of a claimed job, unless the job has since been claimed by another worker.
+
+        :param worker: str, name of the worker that ran the job
+        :param status: str, 'done' or 'failed'
+        :param result: bytes, pickled result or exception
+        """
+        self.connection.execute(
+            "UPDATE broker_jobs SET status = ?, result = ?, finished = ? WHERE id = ? AND worker = ?",
+            (status, result, time.time(), job_id, worker))
+
+    def collect(self, job_ids):
+        """
+        Remove and return the finished jobs among job_ids.
+
+        :param job_ids: list of int, ids of the jobs waited for
+        :return: list of tuples (id, status, result)
+        """
+        if not job_ids:
+            return []
+        placeholders = ','.join('?' * len(job_ids))
+        rows = self.connection.execute(f"""
+        SELECT id, status, result FROM broker_jobs
+        WHERE id IN ({placeholders}) AND status IN ('done', 'failed')
+        """, job_ids).fetchall()
+        self.discard([job_id for job_id, *_ in rows])
+        return rows
+
+    def discard(self, job_ids):
+        if job_ids:
+            self.connection.executemany("DELETE FROM broker_jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+    def clear(self):
+        """Drop all jobs, e.g. those left by a previous run of the bot."""
+        self.connection.execute("DELETE FROM broker_jobs")
+
+    def counts(self):
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM broker_jobs GROUP BY status"))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+
+TRADING_DAYS = 252
+
+
+class EWMCovariance:
+    """
+    Exponentially weighted mean and covariance of daily close-to-close returns.
+
+    New daily bars are folded into the state, O(n^2) per bar, so a refresh
+    costs the same however long the stored history is. A fund without a
+    candle on a day keeps its last close (as the forward-filled panels do)
+    and a fund not yet listed has a zero return, as in Ledoit-Wolf over the
+    panels. Bars that arrive for dates already folded in (late or corrected
+    candles) are not replayed; they only show up in the next return.
+    """
+
+    def __init__(self, halflife, columns=(), last_date=None, last_close=None, mean=None, cov=None, count=0):
+        self.halflife = halflife
+        self.columns = list(columns)
+        self.last_date = last_date
+        n = len(self.columns)
+        self.last_close = np.full(n, np.nan) if last_close is None else last_close
+        self.mean = np.zeros(n) if mean is None else mean
+        self.cov = np.zeros((n, n)) if cov is None else cov
+        self.count = count
+
+    def reset(self, columns):
+        n = len(columns)
+        self.columns = list(columns)
+        self.last_date = None
+        self.last_close = np.full(n, np.nan)
+        self.mean = np.zeros(n)
+        self.cov = np.zeros((n, n))
+        self.count = 0
+
+    @property
+    def alpha(self):
+        return 1 - 0.5 ** (1 / self.halflife)
+
+    def covers(self, columns, last_date):
+        """True if the state is up to date for a panel with these columns and last date."""
+        return self.last_date == last_date and set(columns) <= set(self.columns)
+
+    def update(self, close):
+        """
+        Fold in daily bars.
+
+        The bars are merged into the state as one weighted batch, which gives
+        exactly the same result as the per-bar recursion
+        mean += a * d, cov = (1 - a) * (cov + a * d d'), d = r - mean,
+        for O(k * n^2) in a single matrix product.
+
+        :param close: np.array, close prices (bars, n) or (n,) in column order, NaN for funds without a candle
+        """
+        close = np.atleast_2d(np.asarray(close, dtype=float))
+        prices = pd.DataFrame(np.vstack([self.last_close, close])).ffill().to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = prices[1:] / prices[:-1] - 1
+        returns = np.where(np.isfinite(returns), returns, 0)
+        self.last_close = prices[-1]
+        if self.count == 0:
+            returns = returns[1:]  # первый бар задаёт только цены
+        self.count += len(close)
+        if len(returns) == 0:
+            return
+
+        alpha = self.alpha
+        k = len(returns)
+        weights = alpha * (1 - alpha) ** np.arange(k - 1, -1, -1.0)
+        if self.count - k > 1:
+            previous = (1 - alpha) ** k
+        else:
+            # Первая доходность задаёт начальное среднее
+            previous = 0.0
+            weights[0] = (1 - alpha) ** (k - 1)
+        mean = previous * self.mean + weights @ returns
+        shift = self.mean - mean
+        deviations = returns - mean
+        self.cov = previous * (self.cov + np.outer(shift, shift)) + (deviations * weights[:, None]).T @ deviations
+        self.mean = mean
+
+    def consume(self, close_prices):
+        """
+        Fold in the bars of close_prices after last_date.
+
+        A panel with funds the state has not seen restarts the state from
+        the panel's first row, since their earlier history cannot be folded
+        in out of order.
+
+        :param close_prices: pd.DataFrame, close prices, dates x ISINs
+        :return: int, number of bars folded in
+        """
+        if not set(close_prices.columns) <= set(self.columns):
+            self.reset(sorted(set(self.columns) | set(close_prices.columns)))
+        close = close_prices.reindex(columns=self.columns)
+        dates = close.index.strftime('%Y-%m-%d')
+        new = dates > self.last_date if self.last_date is not None else np.ones(len(dates), dtype=bool)
+        if new.any():
+            self.update(close.to_numpy(dtype=float)[new])
+            self.last_date = dates[new][-1]
+        return int(new.sum())
+
+    def covariance(self, columns, shrinkage=0.0, frequency=TRADING_DAYS):
+        """
+        Annualized covariance of the given funds, shrunk towards a scaled identity.
+
+        :param columns: list of ISINs, order of the result
+        :param shrinkage: float, weight of the target trace(S)/n * I, 0 to disable
+        :param frequency: int, bars per year
+        :return: pd.DataFrame, covariance matrix
+        """
+        index = [self.columns.index(isin) for isin in columns]
+        cov = self.cov[np.ix_(index, index)] * frequency
+        if shrinkage:
+            target = np.trace(cov) / len(cov) * np.identity(len(cov))
+            cov = (1 - shrinkage) * cov + shrinkage * target
+        return pd.DataFrame(cov, index=columns, columns=columns)
+
+    def save(self, connection):
+        """Store the state in the moex_ewm table of the candle database; the caller commits."""
+        n = len(self.columns)
+        connection.execute("DELETE FROM moex_ewm")
+        connection.execute("""
+        INSERT INTO moex_ewm (id, halflife, columns, last_date, count, last_close, mean, cov)
+        VALUES (1, ?, ?, ?, ?, ?, ?, ?)
+        """, (self.halflife, '\n'.join(self.columns), self.last_date, self.count,
+              self.last_close.astype(float).tobytes(), self.mean.astype(float).tobytes(),
+              self.cov.astype(float).reshape(n * n).tobytes()))
+
+    @classmethod
+    def load(cls, connection, halflife):
+        """Stored state, or an empty one if there is none or it was built with another half-life."""
+        row = connection.execute("""
+        SELECT halflife, columns, last_date, count, last_close, mean, cov FROM moex_ewm WHERE id = 1
+        """).fetchone()
+        if row is None or row[0] != halflife:
+            return cls(halflife)
+        _, columns, last_date, count, last_close, mean, cov = row
+        columns = columns.split('\n') if columns else []
+        n = len(columns)
+        return cls(halflife, columns, last_date, np.frombuffer(last_close).copy(), np.frombuffer(mean).copy(),
+                   np.frombuffer(cov).reshape(n, n).copy(), count)
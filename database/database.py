@@ -1,50 +1,53 @@
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import logging
+
+import numpy as np
 import pandas as pd
-import aiohttp
-import aiomoex
 from datetime import datetime, timedelta
 import asyncio
-import matplotlib.pyplot as plt
 import json
 import sqlite3
-from pathlib import Path
-
-df = pd.read_excel('etf_data.xlsx')
-isins = df['Тикер']
+from io import StringIO
 
+from config import USER_DB_POOL_SIZE, USER_DB_COMMIT_WINDOW, COV_ESTIMATOR, EWM_HALFLIFE, EWM_SHRINKAGE
+from database.covariance import EWMCovariance
+from database.iss import iss_client
+from database.pool import ConnectionPool
+from database.universe import get_universe
+from metrics import metrics
 
-class BaseDatabase:
-    def __init__(self, filename, name='Params'):
-        self.base = sqlite3.connect(filename)
-        self.cursor = self.base.cursor()
-        if self.base:
-            print(f"{name} database connected")
+# Начало истории для полной загрузки и перекрытие при инкрементальной
+HISTORY_START = '2022-01-01'
+REFRESH_OVERLAP_DAYS = 3
+CANDLE_INTERVAL = 24  # дневные свечи
+CANDLE_COLUMNS = ('open', 'high', 'low', 'close', 'volume')
+EXCLUDED_ISINS = ('RU000A1013V9', 'RU000A0JTVY1', 'RU000A104172', 'RU000A0JPGC6')
 
-    def close(self):
-        self.base.close()
 
+class UserDatabase:
+    def __init__(self, filename, pool_size=USER_DB_POOL_SIZE, commit_window=USER_DB_COMMIT_WINDOW):
+        self.pool = ConnectionPool(filename, pool_size, commit_window)
+        print("Users database connected")
 
-class UserDatabase(BaseDatabase):
     def create_database(self):
-        self.cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            name TEXT,
-            tag TEXT,
-            risk_profile TEXT,
-            has_portfolio BOOLEAN
-        )""")
-
-        self.cursor.execute("""
-        CREATE TABLE IF NOT EXISTS portfolios (
-            user_id INTEGER,
-            portfolio TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )""")
-        self.base.commit()
+        with self.pool.connection() as connection, connection:
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                name TEXT,
+                tag TEXT,
+                risk_profile TEXT,
+                has_portfolio BOOLEAN
+            )""")
+
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS portfolios (
+                user_id INTEGER,
+                portfolio TEXT,
+                FOREIGN KEY(user_id) REFERENCES users(user_id)
+            )""")
 
     async def save_user(self, user_id, name, tag, risk_profile, has_portfolio):
-        self.cursor.execute("""
+        await self.pool.write("""
         INSERT INTO users (user_id, name, tag, risk_profile, has_portfolio)
         VALUES (?, ?, ?, ?, ?)
         ON CONFLICT(user_id) DO UPDATE SET
@@ -53,22 +56,19 @@ class UserDatabase(BaseDatabase):
             risk_profile=excluded.risk_profile,
             has_portfolio=excluded.has_portfolio
         """, (user_id, name, tag, risk_profile, has_portfolio))
-        self.base.commit()
 
     async def save_portfolio(self, user_id, portfolio):
         pass
-        # self.cursor.execute("""
+        # await self.pool.write("""
         # INSERT INTO portfolios (user_id, portfolio)
         # VALUES (?, ?)
         # ON CONFLICT(user_id) DO UPDATE SET
         #     portfolio=excluded.portfolio
         # """, (user_id, portfolio))
-        # self.base.commit()
 
     async def get_portfolio(self, user_id):
-        self.cursor.execute(
+        return await self.pool.fetchone(
             "SELECT portfolio FROM portfolios WHERE user_id = ?", (user_id,))
-        return self.cursor.fetchone()
 
     async def parse_portfolio(self, portfolio_str):
         portfolio = json.loads(portfolio_str)
@@ -80,22 +80,22 @@ class UserDatabase(BaseDatabase):
         pass
 
     async def get_user(self, user_id):
-        self.cursor.execute(
+        return await self.pool.fetchone(
             "SELECT * FROM users WHERE user_id = ?", (user_id,))
-        return self.cursor.fetchone()
 
     async def user_has_risk_profile(self, user_id):
-        self.cursor.execute(
+        result = await self.pool.fetchone(
             "SELECT risk_profile FROM users WHERE user_id = ?", (user_id,))
-        result = self.cursor.fetchone()
         return result is not None and result[0] is not None
 
     async def user_has_portfolio(self, user_id):
-        self.cursor.execute(
+        result = await self.pool.fetchone(
             "SELECT has_portfolio FROM users WHERE user_id = ?", (user_id,))
-        result = self.cursor.fetchone()
         return result is not None and result[0] is not None
 
+    async def close(self):
+        await self.pool.close()
+
 
 # Создание экземпляра базы данных
 user_db = UserDatabase("users.db")
@@ -113,86 +113,354 @@ class BaseDatabase:
         self.base.close()
 
 
+class PanelCache:
+    """Cleaned open/close/volume panels of a single data version."""
+
+    def __init__(self):
+        self.entry = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version):
+        entry = self.entry
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, version, panels):
+        # Версия и панели меняются одним присваиванием
+        self.entry = (version, panels)
+
+    def invalidate(self):
+        self.entry = None
+
+
 class MoexDatabase(BaseDatabase):
+    def __init__(self, filename, name='Params'):
+        super().__init__(filename, name)
+        # Воркеры расчётов читают базу из других процессов во время ежечасной записи
+        self.base.execute("PRAGMA journal_mode=WAL")
+        self.base.execute("PRAGMA synchronous=NORMAL")
+        self.data_version = 0
+        self.panel_cache = PanelCache()
+        # Корутины-обработчики, вызываемые с новой версией после каждого обновления
+        self.refresh_listeners = []
+
     def create_database(self):
+        # Одна строка на свечу: (isin, date) -> OHLCV, NaN хранится как NULL
         self.cursor.execute("""
-        CREATE TABLE IF NOT EXISTS moex_data (
+        CREATE TABLE IF NOT EXISTS moex_candles (
+            isin TEXT NOT NULL,
+            date TEXT NOT NULL,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            volume REAL,
+            PRIMARY KEY (isin, date)
+        ) WITHOUT ROWID""")
+        self.cursor.execute("""
+        CREATE INDEX IF NOT EXISTS moex_candles_date ON moex_candles (date)
+        """)
+
+        # Дата последней загруженной свечи по каждому фонду
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS moex_watermarks (
             isin TEXT PRIMARY KEY,
-            open_prices TEXT,
-            close_prices TEXT,
-            volumes TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            last_end DATETIME
         )""")
-        self.base.commit()
 
-    async def save_moex_data(self, isin, open_prices, close_prices, volumes):
+        # Версия данных увеличивается при каждом обновлении свечей
         self.cursor.execute("""
-        INSERT INTO moex_data (isin, open_prices, close_prices, volumes, timestamp)
-        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ON CONFLICT(isin) DO UPDATE SET
-            open_prices=excluded.open_prices,
-            close_prices=excluded.close_prices,
-            volumes=excluded.volumes,
-            timestamp=CURRENT_TIMESTAMP
-        """, (isin, open_prices, close_prices, volumes))
-        self.base.commit()
-
-    async def get_moex_stock(self, session, ticker, start='2022-01-01', end=datetime.now().strftime("%Y-%m-%d")):
-        request_url = f"https://iss.moex.com/iss/engines/stock/markets/shares/boards/TQIF/securities/{ticker}/candles.json?from={start}&till={end}"
-        iss = aiomoex.ISSClient(session, request_url)
-        data = await iss.get()
-        df = pd.DataFrame(data['candles'])
-        return df
-
-    async def update_moex_data(self, isins):
-        async with aiohttp.ClientSession() as session:
-            tasks = [self.get_moex_stock(session, isin) for isin in isins]
-            results = await asyncio.gather(*tasks)
-            for (isin, df) in zip(isins, results):
-                df['ISIN'] = isin
+        CREATE TABLE IF NOT EXISTS moex_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )""")
+        self.cursor.execute("""
+        INSERT OR IGNORE INTO moex_meta (key, value) VALUES ('data_version', 0)
+        """)
 
-            results = [df for df in results if len(df) > 0 and
-                       df['ISIN'].values[0] not in ('RU000A1013V9', 'RU000A0JTVY1', 'RU000A104172', 'RU000A0JPGC6')]
+        # Состояние экспоненциально взвешенной ковариации (COV_ESTIMATOR=ewm), одна строка
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS moex_ewm (
+            id INTEGER PRIMARY KEY,
+            halflife REAL,
+            columns TEXT,
+            last_date TEXT,
+            count INTEGER,
+            last_close BLOB,
+            mean BLOB,
+            cov BLOB
+        )""")
+        self.base.commit()
+        self.migrate_blob_table()
+        self.load_data_version()
 
-        for df in results:
-            df_c = df.copy(deep=True)
-            isin = df_c['ISIN'].values[0]
+    def load_data_version(self):
+        self.cursor.execute(
+            "SELECT value FROM moex_meta WHERE key = 'data_version'")
+        self.data_version = self.cursor.fetchone()[0]
+        return self.data_version
+
+    def migrate_blob_table(self):
+        """
+        Move candles from the legacy moex_data table (one JSON blob per series)
+        into moex_candles and drop it.
+
+        Blobs written before the series were indexed by date carry only row
+        positions; those ISINs lose their watermark so the next refresh
+        backfills them from HISTORY_START.
+        """
+        self.cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'moex_data'")
+        if self.cursor.fetchone() is None:
+            return
 
-            price_open = df_c[['open']].rename({'open': isin}, axis=1)
-            price_close = df_c[['close']].rename({'close': isin}, axis=1)
-            volume = df_c[['volume']].rename({'volume': isin}, axis=1)
+        self.cursor.execute(
+            "SELECT isin, open_prices, close_prices, volumes FROM moex_data")
+        for isin, *blobs in self.cursor.fetchall():
+            candles = pd.concat([pd.read_json(StringIO(blob)) for blob in blobs], axis=1)
+            if not isinstance(candles.index, pd.DatetimeIndex):
+                self.cursor.execute(
+                    "DELETE FROM moex_watermarks WHERE isin = ?", (isin,))
+                continue
+            candles.columns = ['open', 'close', 'volume']
+            candles['high'] = candles['low'] = None
+            self.save_candles(isin, candles)
+
+        self.cursor.execute("DROP TABLE moex_data")
+        self.base.commit()
 
-            # Save data to database
-            await self.save_moex_data(isin, price_open.to_json(), price_close.to_json(), volume.to_json())
+    def save_candles(self, isin, candles):
+        """
+        Upsert candles of one ISIN; rows for already stored dates are replaced.
+
+        :param isin: str, fund ISIN
+        :param candles: pd.DataFrame indexed by date with open, high, low, close, volume columns
+        :return: int, number of rows inserted or actually changed
+        """
+        rows = zip([isin] * len(candles), candles.index.strftime('%Y-%m-%d'),
+                   *(candles[column].astype(float).tolist() for column in CANDLE_COLUMNS))
+        self.cursor.executemany("""
+        INSERT INTO moex_candles (isin, date, open, high, low, close, volume)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(isin, date) DO UPDATE SET
+            open=excluded.open,
+            high=excluded.high,
+            low=excluded.low,
+            close=excluded.close,
+            volume=excluded.volume
+        -- совпадающая свеча не перезаписывается и не считается изменением
+        WHERE open IS NOT excluded.open
+            OR high IS NOT excluded.high
+            OR low IS NOT excluded.low
+            OR close IS NOT excluded.close
+            OR volume IS NOT excluded.volume
+        """, rows)
+        return self.cursor.rowcount
+
+    async def save_watermark(self, isin, last_end):
+        self.cursor.execute("""
+        INSERT INTO moex_watermarks (isin, last_end)
+        VALUES (?, ?)
+        ON CONFLICT(isin) DO UPDATE SET
+            last_end=excluded.last_end
+        """, (isin, last_end))
+
+    async def get_watermarks(self):
+        self.cursor.execute("SELECT isin, last_end FROM moex_watermarks")
+        return {isin: datetime.fromisoformat(last_end)
+                for isin, last_end in self.cursor.fetchall()}
+
+    async def get_moex_stock(self, ticker, start=HISTORY_START, end=None):
+        end = end or datetime.now().strftime("%Y-%m-%d")
+        candles = await iss_client.get_candles(ticker, start, end, CANDLE_INTERVAL)
+        return pd.DataFrame(candles)
+
+    async def update_moex_data(self, isins, full=False):
+        """
+        Load new candles from MOEX ISS and merge them into the stored history.
+
+        Only candles after the per-ISIN watermark are requested (minus
+        REFRESH_OVERLAP_DAYS, so that corrected bars are picked up). ISINs
+        without a watermark and any call with full=True are re-backfilled
+        from HISTORY_START.
+
+        An ISIN that fails to load keeps its stored candles and watermark and
+        is retried on the next refresh. If no stored candle was added or
+        changed (the overlap re-fetches bars that are usually identical), the
+        data version is left as is, no listener is fired and the cached
+        panels keep being served.
+
+        :param isins: iterable of ISINs to refresh
+        :param full: bool, ignore watermarks and reload the whole history
+        """
+        # Исключённые фонды не запрашиваются вовсе
+        isins = [isin for isin in isins if isin not in EXCLUDED_ISINS]
+        watermarks = {} if full else await self.get_watermarks()
+        starts = {}
+        for isin in isins:
+            if isin in watermarks:
+                start = watermarks[isin] - timedelta(days=REFRESH_OVERLAP_DAYS)
+                starts[isin] = start.strftime("%Y-%m-%d")
+            else:
+                starts[isin] = HISTORY_START
+
+        with metrics.timer('iss_fetch'):
+            loaded, failed = await iss_client.get_many(
+                lambda isin: self.get_moex_stock(isin, start=starts[isin]), isins)
+        metrics.inc('iss_failed_isins_total', len(failed))
+        if failed:
+            logging.warning(f"MOEX ISS refresh failed for {len(failed)} of {len(isins)} ISINs, "
+                            f"e.g. {next(iter(failed.items()))}")
+
+        results = [df.assign(ISIN=isin) for isin, df in loaded.items()
+                   if len(df) > 0]
+        if not results:
+            return
+
+        with metrics.timer('candles_write'):
+            changed = 0
+            for df in results:
+                isin = df['ISIN'].values[0]
+                candles = df.set_index(pd.to_datetime(df['begin']).dt.normalize())
+
+                # Свежие свечи перезаписывают сохранённые за те же даты
+                changed += self.save_candles(isin, candles)
+                await self.save_watermark(isin, df['end'].max())
+
+            if not changed:
+                self.base.commit()
+                return
+
+            if COV_ESTIMATOR == 'ewm':
+                with metrics.timer('ewm_update'):
+                    self.update_covariance(full)
+
+            self.cursor.execute("""
+            UPDATE moex_meta SET value = value + 1 WHERE key = 'data_version'
+            """)
+            self.base.commit()
+        self.panel_cache.invalidate()
+        self.load_data_version()
+
+        for listener in self.refresh_listeners:
+            asyncio.create_task(listener(self.data_version))
+
+    def update_covariance(self, full=False):
+        """
+        Fold the candles stored after the EWM state's last date into it, in the current transaction.
+
+        Only the new rows are read; the whole history is read when the
+        state is empty, full is set or a fund appears for the first time.
+
+        :param full: bool, rebuild the state from the whole history
+        """
+        state = EWMCovariance(EWM_HALFLIFE) if full else EWMCovariance.load(self.base, EWM_HALFLIFE)
+        open_prices, close_prices, volumes = self.read_candles(start=state.last_date)
+        if state.last_date is not None and not set(close_prices.columns) <= set(state.columns):
+            open_prices, close_prices, volumes = self.read_candles()
+        if len(close_prices):
+            state.consume(close_prices)
+            state.save(self.base)
+        return state
+
+    def ewm_covariance(self, close_prices):
+        """
+        Annualized EW covariance of the panel's funds, shrunk by EWM_SHRINKAGE.
+
+        The stored state is used when it ends on the panel's last date;
+        otherwise (a refresh in between, or no state yet) it is folded from
+        the panel itself.
+
+        :param close_prices: pd.DataFrame, forward-filled close prices, dates x ISINs
+        :return: pd.DataFrame, covariance matrix
+        """
+        state = EWMCovariance.load(self.base, EWM_HALFLIFE)
+        if not state.covers(close_prices.columns, close_prices.index[-1].strftime('%Y-%m-%d')):
+            state = EWMCovariance(EWM_HALFLIFE)
+            state.consume(close_prices)
+        return state.covariance(list(close_prices.columns), EWM_SHRINKAGE)
 
     async def get_cached_moex_data(self):
-        self.cursor.execute(
-            "SELECT isin, open_prices, close_prices, volumes FROM moex_data")
+        return self.get_panels()
+
+    def get_panels(self, version=None):
+        """
+        Return open/close/volume panels of the current data version, prices forward-filled.
+
+        Panels are read from SQLite once per version and then shared between
+        all callers, so they must not be modified in place. A version newer
+        than the one known to this process (e.g. in a compute worker) makes
+        it re-read the version from the database first.
+
+        :param version: int, data version the caller expects, optional
+        :return: tuple of pd.DataFrame, open prices, close prices and volumes
+        """
+        if version is not None and version != self.data_version:
+            self.load_data_version()
+        version = self.data_version
+        panels = self.panel_cache.get(version)
+        if panels is None:
+            with metrics.timer('panels_read'):
+                open_prices, close_prices, volumes = self.read_candles()
+            with metrics.timer('panels_clean'):
+                # Цены переносятся с последней сделки, а день без свечи — день без оборота
+                panels = open_prices.ffill(), close_prices.ffill(), volumes.fillna(0)
+            self.panel_cache.put(version, panels)
+        return panels
+
+    def count_dates(self):
+        """Number of rows of the panels, counted on the date index without reading them."""
+        self.cursor.execute("SELECT COUNT(DISTINCT date) FROM moex_candles")
+        return self.cursor.fetchone()[0]
+
+    def read_candles(self, start=None, end=None):
+        """
+        Read the stored candles as date x ISIN panels.
+
+        :param start: str, first date to include (YYYY-MM-DD), optional
+        :param end: str, last date to include (YYYY-MM-DD), optional
+        :return: tuple of pd.DataFrame, open prices, close prices and volumes
+        """
+        self.cursor.execute("""
+        SELECT date, isin, open, close, volume FROM moex_candles
+        WHERE date >= ? AND date <= ?
+        ORDER BY date, isin
+        """, (start or '0000-00-00', end or '9999-99-99'))
         rows = self.cursor.fetchall()
-        open_prices = []
-        close_prices = []
-        volumes = []
+        if not rows:
+            empty = pd.DataFrame()
+            return empty, empty, empty
+
+        dates, tickers, *values = zip(*rows)
+        dates, date_idx = np.unique(dates, return_inverse=True)
+        tickers, isin_idx = np.unique(tickers, return_inverse=True)
 
-        for row in rows:
-            isin, open_price, close_price, volume = row
-            open_prices.append(pd.read_json(open_price))
-            close_prices.append(pd.read_json(close_price))
-            volumes.append(pd.read_json(volume))
+        panels = []
+        for column in values:
+            panel = np.full((len(dates), len(tickers)), np.nan)
+            panel[date_idx, isin_idx] = np.array(column, dtype=float)
+            panels.append(pd.DataFrame(panel, index=pd.DatetimeIndex(dates), columns=tickers))
 
-        return pd.concat(open_prices, axis=1), pd.concat(close_prices, axis=1), pd.concat(volumes, axis=1)
+        open_prices, close_prices, volumes = panels
+        return open_prices, close_prices, volumes
 
 
 moex_db = MoexDatabase("moex_data.db")
 moex_db.create_database()
+metrics.track_cache('panels', moex_db.panel_cache)
+metrics.gauge('data_version', lambda: moex_db.data_version, 'Version of the stored MOEX candles')
 
 
 async def update_data_periodically():
     while True:
-        await moex_db.update_moex_data(isins)
+        try:
+            with metrics.timer('refresh'):
+                await moex_db.update_moex_data(get_universe().tickers)
+        except Exception:
+            metrics.inc('refresh_errors_total')
+            logging.exception("MOEX data refresh failed, serving the last stored data")
         await asyncio.sleep(3600)  # Обновлять данные каждый час
-
-# Запуск обновления данных в фоновом режиме
-scheduler = AsyncIOScheduler()
-scheduler.add_job(lambda: asyncio.run(
-    moex_db.update_moex_data(isins)), 'interval', hours=1)
-scheduler.start()
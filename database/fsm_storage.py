@@ -0,0 +1,205 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+import typing
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from config import FSM_STORAGE_PATH, FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL, FSM_TTL
+from database.pool import ConnectionPool
+
+EMPTY_RECORD = {'state': None, 'data': {}, 'bucket': {}}
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage persisted in SQLite with a bounded in-memory LRU front.
+
+    Only the max_cached most recently active conversations are kept in
+    memory. Changes are marked dirty and written behind by a background
+    task every flush_interval seconds, so handlers never wait for disk.
+    Conversations untouched for ttl seconds expire from memory and from
+    the database. State survives restarts: close() flushes what is left.
+    """
+
+    def __init__(self, filename=FSM_STORAGE_PATH, max_cached=FSM_CACHE_SIZE,
+                 flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_TTL):
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.pool = ConnectionPool(filename, size=1)
+        with self.pool.connection() as connection, connection:
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                chat TEXT,
+                user TEXT,
+                state TEXT,
+                data TEXT,
+                bucket TEXT,
+                updated REAL,
+                PRIMARY KEY (chat, user)
+            )""")
+            connection.execute("""
+            CREATE INDEX IF NOT EXISTS fsm_states_updated ON fsm_states (updated)
+            """)
+
+        self.records = OrderedDict()
+        # (chat, user) -> запись для записи в базу или None для удаления
+        self.dirty = {}
+        self.flush_task = None
+
+    def _load(self, connection, key):
+        row = connection.execute(
+            "SELECT state, data, bucket, updated FROM fsm_states WHERE chat = ? AND user = ?", key).fetchone()
+        if row is None or row[3] < time.time() - self.ttl:
+            return None
+        state, data, bucket, updated = row
+        return {'state': state, 'data': json.loads(data), 'bucket': json.loads(bucket), 'updated': updated}
+
+    async def _get(self, chat, user):
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self.records.get(key)
+        if record is None:
+            if key in self.dirty:
+                record = self.dirty[key]
+            else:
+                record = await self.pool.run(self._load, key)
+            # Пока шла загрузка, запись могла появиться в памяти
+            if key in self.records:
+                record = self.records[key]
+            elif record is None:
+                record = dict(copy.deepcopy(EMPTY_RECORD), updated=time.time())
+            self.records[key] = record
+            while len(self.records) > self.max_cached:
+                self.records.popitem(last=False)
+        self.records.move_to_end(key)
+        return key, record
+
+    def _touch(self, key, record):
+        record['updated'] = time.time()
+        if {name: record[name] for name in EMPTY_RECORD} == EMPTY_RECORD:
+            self.records.pop(key, None)
+            self.dirty[key] = None
+        else:
+            self.dirty[key] = record
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_periodically())
+
+    def _write(self, connection, deleted, upserted, cutoff):
+        with connection:
+            connection.executemany(
+                "DELETE FROM fsm_states WHERE chat = ? AND user = ?", deleted)
+            connection.executemany("""
+            INSERT INTO fsm_states (chat, user, state, data, bucket, updated)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat, user) DO UPDATE SET
+                state=excluded.state,
+                data=excluded.data,
+                bucket=excluded.bucket,
+                updated=excluded.updated
+            """, upserted)
+            connection.execute("DELETE FROM fsm_states WHERE updated < ?", (cutoff,))
+
+    async def flush(self):
+        batch, self.dirty = self.dirty, {}
+        cutoff = time.time() - self.ttl
+        for key in [key for key, record in self.records.items() if record['updated'] < cutoff]:
+            del self.records[key]
+
+        # Сериализуем в потоке цикла событий, пока записи никто не меняет
+        deleted = [key for key, record in batch.items() if record is None]
+        upserted = [(*key, record['state'], json.dumps(record['data']), json.dumps(record['bucket']),
+                     record['updated'])
+                    for key, record in batch.items() if record is not None]
+        try:
+            await self.pool.run(self._write, deleted, upserted, cutoff)
+        except Exception:
+            # Вернём неудачный пакет, не затирая более свежие изменения
+            for key, record in batch.items():
+                self.dirty.setdefault(key, record)
+            raise
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("FSM storage flush failed")
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        await self.pool.close()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        key, record = await self._get(chat, user)
+        return record['state'] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        key, record = await self._get(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._get(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._touch(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        self._touch(key, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, record = await self._get(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        self._touch(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        key, record = await self._get(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        self._touch(key, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, record = await self._get(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        self._touch(key, record)
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+from metrics import metrics
+from config import (ISS_BASE_URL, ISS_CONCURRENCY, ISS_TIMEOUT, ISS_RETRIES, ISS_BACKOFF,
+                    ISS_BREAKER_THRESHOLD, ISS_BREAKER_RESET)
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ISSError(Exception):
+    """Request to MOEX ISS failed after all retries."""
+
+
+class CircuitOpen(ISSError):
+    """ISS is considered down; requests are not sent until the breaker resets."""
+
+    def __init__(self, retry_in):
+        super().__init__(f"MOEX ISS circuit is open, next probe in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Stops calling ISS after `threshold` consecutive failed requests.
+
+    After `reset_timeout` seconds one probe request is let through: success
+    closes the breaker, failure keeps it open for another period.
+    """
+
+    def __init__(self, threshold=ISS_BREAKER_THRESHOLD, reset_timeout=ISS_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.probing else 'open'
+
+    def check(self):
+        """
+        Raise CircuitOpen unless a request may be sent.
+
+        :return: bool, True if this request is the probe of a half-open breaker
+        """
+        if self.opened_at is None:
+            return False
+        retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+        if retry_in > 0 or self.probing:
+            raise CircuitOpen(max(retry_in, 0))
+        self.probing = True
+        return True
+
+    def release(self):
+        """End a probe that neither succeeded nor failed, so the next request can probe again."""
+        self.probing = False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.warning(f"MOEX ISS circuit opened after {self.failures} failed requests")
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class ISSClient:
+    """
+    MOEX ISS client with one shared connection pool.
+
+    At most `concurrency` requests are in flight. Each page request has its
+    own timeout and is retried with exponential backoff and jitter on network
+    errors, timeouts and 429/5xx responses. Requests that fail on those
+    transient errors feed a circuit breaker. `base_url` can point to a local fake server in tests.
+    """
+
+    def __init__(self, base_url=ISS_BASE_URL, concurrency=ISS_CONCURRENCY, timeout=ISS_TIMEOUT,
+                 retries=ISS_RETRIES, backoff=ISS_BACKOFF, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def get(self, path, query):
+        """
+        Load one page in the extended JSON format, retrying transient errors.
+
+        :param path: str, request path relative to base_url
+        :param query: dict, request parameters
+        :return: dict, table name -> list of rows
+        """
+        probe = self.breaker.check()
+        try:
+            return await self._get(path, query)
+        finally:
+            # Отменённая или упавшая не по вине ISS проба не должна оставить breaker полуоткрытым
+            if probe and self.breaker.probing:
+                self.breaker.release()
+
+    async def _get(self, path, query):
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        query = {'iss.json': 'extended', 'iss.meta': 'off', **query}
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    started = time.perf_counter()
+                    async with self.get_session().get(url, params=query) as response:
+                        # Время до заголовков ответа; чтение и разбор тела — отдельный этап
+                        metrics.observe('iss_response', time.perf_counter() - started)
+                        if response.status not in RETRY_STATUSES:
+                            response.raise_for_status()
+                            with metrics.timer('iss_json'):
+                                data = await response.json()
+                            self.breaker.success()
+                            return data[1]
+                        error = ISSError(f"{url}: HTTP {response.status}")
+            except aiohttp.ClientResponseError as err:
+                # 4xx кроме 429 и ответ не в JSON повторять бесполезно; ISS при этом доступна,
+                # поэтому ошибка одного запроса не открывает breaker для всех
+                raise ISSError(f"{url}: HTTP {err.status}") from err
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                error = ISSError(f"{url}: {err!r}")
+                error.__cause__ = err
+            if attempt < self.retries:
+                metrics.inc('iss_retries_total')
+                await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        self.breaker.failure()
+        raise error
+
+    async def get_all(self, path, query, table):
+        """
+        Load all pages of one table.
+
+        :param path: str, request path relative to base_url
+        :param query: dict, request parameters
+        :param table: str, name of the paginated table
+        :return: list of rows
+        """
+        rows = []
+        while True:
+            block = (await self.get(path, {**query, 'start': len(rows)} if rows else query)).get(table, [])
+            if not block:
+                return rows
+            rows.extend(block)
+
+    async def get_candles(self, isin, start, end, interval):
+        path = f"engines/stock/markets/shares/boards/TQIF/securities/{isin}/candles.json"
+        return await self.get_all(path, {'from': start, 'till': end, 'interval': interval}, 'candles')
+
+    async def get_many(self, fetch, keys):
+        """
+        Run fetch(key) for every key, isolating per-key failures.
+
+        :param fetch: coroutine function of one key
+        :param keys: iterable of keys, e.g. ISINs
+        :return: tuple of dicts, key -> result and key -> exception
+        """
+        keys = list(keys)
+        results = await asyncio.gather(*(fetch(key) for key in keys), return_exceptions=True)
+        loaded, failed = {}, {}
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                failed[key] = result
+            else:
+                loaded[key] = result
+        return loaded, failed
+
+
+iss_client = ISSClient()
+metrics.gauge('iss_circuit_open', lambda: int(iss_client.breaker.state != 'closed'),
+              'Whether MOEX ISS requests are suspended by the circuit breaker')
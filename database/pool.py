@@ -0,0 +1,116 @@
+import asyncio
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """
+    Small pool of sqlite3 connections used from a thread executor.
+
+    Every connection runs in WAL mode, so readers do not block the writer.
+    Statements are kept as constant SQL strings by the callers, which lets
+    sqlite3 reuse its per-connection cache of prepared statements.
+
+    Writes are group-committed: write() queues the statement, and all
+    statements queued within commit_window seconds are executed in one
+    transaction, paying for a single fsync.
+    """
+
+    def __init__(self, filename, size=4, commit_window=0.05):
+        self.commit_window = commit_window
+        self.executor = ThreadPoolExecutor(size, thread_name_prefix='sqlite')
+        self.connections = queue.Queue()
+        for _ in range(size):
+            connection = sqlite3.connect(filename, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.connections.put(connection)
+        self.pending = []
+        self.flush_task = None
+
+    @contextmanager
+    def connection(self):
+        connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+    def _fetch(self, sql, params, one):
+        with self.connection() as connection:
+            cursor = connection.execute(sql, params)
+            return cursor.fetchone() if one else cursor.fetchall()
+
+    async def fetchone(self, sql, params=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._fetch, sql, params, True)
+
+    async def fetchall(self, sql, params=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._fetch, sql, params, False)
+
+    def _run(self, fn, args):
+        with self.connection() as connection:
+            return fn(connection, *args)
+
+    async def run(self, fn, *args):
+        """Call fn(connection, *args) on a pooled connection in the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run, fn, args)
+
+    async def write(self, sql, params=()):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((sql, params, future))
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+        await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.commit_window)
+        await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        self.flush_task = None
+        if not batch:
+            return
+        loop = asyncio.get_running_loop()
+        errors = await loop.run_in_executor(self.executor, self._commit, batch)
+        for (_, _, future), error in zip(batch, errors):
+            if future.done():
+                continue  # писатель отменён (таймаут обработчика, остановка), запись всё равно сохранена
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _commit(self, batch):
+        with self.connection() as connection:
+            try:
+                with connection:
+                    for sql, params, _ in batch:
+                        connection.execute(sql, params)
+                return [None] * len(batch)
+            except sqlite3.Error:
+                pass
+
+            # Пакет откатился: выполняем запросы по одному, чтобы ошибка досталась только своему
+            errors = []
+            for sql, params, _ in batch:
+                try:
+                    with connection:
+                        connection.execute(sql, params)
+                    errors.append(None)
+                except sqlite3.Error as error:
+                    errors.append(error)
+            return errors
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.flush()
+        self.executor.shutdown(wait=True)
+        while not self.connections.empty():
+            self.connections.get().close()
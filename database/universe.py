@@ -0,0 +1,124 @@
+import os
+import sqlite3
+from collections import Counter
+
+import numpy as np
+
+UNIVERSE_DB = 'moex_data.db'
+ETF_DATA_PATH = 'etf_data.xlsx'
+ETF_MARKET_PATH = 'etf_market.xlsx'
+
+
+class AlignedUniverse:
+    """
+    Fund attributes as arrays in the column order of a price panel.
+
+    names are the display names, unique within the panel: a name shared by
+    several funds is followed by the fund's ISIN.
+    """
+
+    def __init__(self, universe, columns):
+        self.columns = list(columns)
+        names = [universe.names.get(isin, isin) for isin in self.columns]
+        # Одноимённые фонды различаются по ISIN, иначе их веса сливаются в один ключ
+        counts = Counter(names)
+        self.names = [f"{name} ({isin})" if counts[name] > 1 else name
+                      for isin, name in zip(self.columns, names)]
+        self.nav = np.array([universe.nav.get(isin, np.nan) for isin in self.columns], dtype=float)
+        # Фонды без СЧА в etf_market.xlsx получают нулевой рыночный вес
+        nav = np.nan_to_num(self.nav)
+        self.weights = nav / nav.sum() if nav.sum() > 0 else nav
+
+
+class Universe:
+    """
+    ETF universe compiled from etf_data.xlsx and etf_market.xlsx.
+
+    tickers keeps the order of etf_data.xlsx; names and nav map an ISIN to
+    its fund name and net asset value (market funds only); index maps an
+    ISIN to its position in tickers.
+    """
+
+    def __init__(self, rows):
+        self.tickers = [isin for isin, *_ in rows]
+        self.index = {isin: position for position, isin in enumerate(self.tickers)}
+        self.names = {isin: name for isin, name, nav in rows}
+        self.nav = {isin: nav for isin, name, nav in rows if nav is not None}
+        self._aligned = {}
+
+    @property
+    def market_isins(self):
+        return list(self.nav)
+
+    def align(self, columns):
+        key = tuple(columns)
+        aligned = self._aligned.get(key)
+        if aligned is None:
+            aligned = self._aligned[key] = AlignedUniverse(self, key)
+        return aligned
+
+
+def _source_mtimes():
+    return os.path.getmtime(ETF_DATA_PATH), os.path.getmtime(ETF_MARKET_PATH)
+
+
+def _parse_spreadsheets():
+    import pandas as pd
+
+    data = pd.read_excel(ETF_DATA_PATH)
+    market = pd.read_excel(ETF_MARKET_PATH)
+    names = dict(zip(data['Тикер'], data['ETF & Funds']))
+    names.update(zip(market['ISIN'], market['Название']))
+    nav = dict(zip(market['ISIN'], market['СЧА, руб'].astype(float)))
+
+    tickers = list(dict.fromkeys([*data['Тикер'], *market['ISIN']]))
+    return [(isin, names[isin], nav.get(isin)) for isin in tickers]
+
+
+def _load(connection, mtimes):
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS universe (
+        position INTEGER PRIMARY KEY,
+        isin TEXT,
+        name TEXT,
+        nav REAL
+    )""")
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS universe_meta (
+        source TEXT PRIMARY KEY,
+        mtime REAL
+    )""")
+    stored = dict(connection.execute("SELECT source, mtime FROM universe_meta"))
+    if stored == dict(zip((ETF_DATA_PATH, ETF_MARKET_PATH), mtimes)):
+        return connection.execute("SELECT isin, name, nav FROM universe ORDER BY position").fetchall()
+
+    rows = _parse_spreadsheets()
+    with connection:
+        connection.execute("DELETE FROM universe")
+        connection.executemany("INSERT INTO universe (position, isin, name, nav) VALUES (?, ?, ?, ?)",
+                               [(position, *row) for position, row in enumerate(rows)])
+        connection.execute("DELETE FROM universe_meta")
+        connection.executemany("INSERT INTO universe_meta (source, mtime) VALUES (?, ?)",
+                               zip((ETF_DATA_PATH, ETF_MARKET_PATH), mtimes))
+    return rows
+
+
+_universe = None
+
+
+def get_universe():
+    """
+    Return the ETF universe, re-reading the spreadsheets only when they change.
+
+    The compiled universe is stored in SQLite together with the spreadsheets'
+    mtimes, so a restart does not parse Excel again.
+    """
+    global _universe
+    mtimes = _source_mtimes()
+    if _universe is None or _universe[0] != mtimes:
+        connection = sqlite3.connect(UNIVERSE_DB)
+        try:
+            _universe = (mtimes, Universe(_load(connection, mtimes)))
+        finally:
+            connection.close()
+    return _universe[1]
@@ -1 +1 @@
-from handlers import user
+from handlers import admin, user
@@ -0,0 +1,34 @@
+from aiogram import types
+
+from loader import dp, ADMIN_ID
+from metrics import metrics
+from model.backtest import latest_backtest
+
+
+def is_admin(message: types.Message):
+    return str(message.from_user.id) == str(ADMIN_ID)
+
+
+@dp.message_handler(commands=['metrics'], state='*')
+async def show_metrics(message: types.Message):
+    # Команды доступны только администратору, остальным бот не отвечает
+    if not is_admin(message):
+        return
+    await message.answer(metrics.summary())
+
+
+@dp.message_handler(commands=['backtest'], state='*')
+async def show_backtest(message: types.Message):
+    if not is_admin(message):
+        return
+    report = latest_backtest()
+    if report is None:
+        await message.answer("Бэктест ещё не рассчитан.")
+        return
+    await message.answer("\n\n".join(
+        f"{risk_level} ({stats['years']} г., {stats['rebalances']} ребалансировок):\n"
+        f"Доходность: {stats['cumulative_return'] * 100:.2f}% ({stats['annual_return'] * 100:.2f}% годовых)\n"
+        f"Волатильность: {stats['annual_volatility'] * 100:.2f}%\n"
+        f"Макс. просадка: {stats['max_drawdown'] * 100:.2f}%\n"
+        f"Оборот: {stats['annual_turnover'] * 100:.0f}% в год"
+        for risk_level, stats in report.items()))
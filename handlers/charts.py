@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from aiogram import types
+
+from config import CHART_CACHE_SIZE
+from metrics import metrics
+from model.cache import LRUCache
+
+PORTFOLIO_FIGSIZE = (15, 13)
+
+# Все диаграммы рисуются в одном потоке, фигуры переиспользуются между запросами
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='charts')
+_figures = {}
+
+# PNG по хэшу весов и file_id уже загруженных в Telegram диаграмм
+rendered_charts = LRUCache(CHART_CACHE_SIZE)
+uploaded_charts = LRUCache(CHART_CACHE_SIZE)
+metrics.track_cache('rendered_charts', rendered_charts)
+metrics.track_cache('uploaded_charts', uploaded_charts)
+
+
+def chart_key(weights, figsize):
+    payload = json.dumps([figsize, sorted(weights.items())], ensure_ascii=False)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def _render_pie_chart(weights, figsize):
+    # matplotlib загружается при первой диаграмме, а не при старте бота
+    from matplotlib.figure import Figure
+
+    fig = _figures.get(figsize)
+    if fig is None:
+        fig = _figures[figsize] = Figure(figsize=figsize)
+    fig.clear()
+
+    ax = fig.subplots()
+    ax.pie(weights.values(), labels=weights.keys(), autopct='%1.1f%%')
+    ax.axis('equal')
+
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+async def render_pie_chart(weights, figsize=PORTFOLIO_FIGSIZE):
+    """
+    PNG pie chart of the portfolio weights, rendered off the event loop.
+
+    :param weights: dict, asset name -> weight
+    :param figsize: tuple, figure size in inches, None for the matplotlib default
+    :return: bytes, PNG image
+    """
+    key = chart_key(weights, figsize)
+    png = rendered_charts.get(key)
+    if png is None:
+        loop = asyncio.get_running_loop()
+        with metrics.timer('render_chart'):
+            png = await loop.run_in_executor(_executor, _render_pie_chart, weights, figsize)
+        rendered_charts.put(key, png)
+    return png
+
+
+async def send_pie_chart(send, weights, figsize=PORTFOLIO_FIGSIZE, **kwargs):
+    """
+    Send the portfolio pie chart, re-using the Telegram file_id of an identical earlier upload.
+
+    :param send: coroutine function taking the file first, e.g. message.answer_document
+    :param weights: dict, asset name -> weight
+    :param figsize: tuple, figure size in inches, None for the matplotlib default
+    :return: types.Message, the sent message
+    """
+    # file_id документа нельзя отправить как фото, поэтому учитываем способ отправки
+    key = (send.__name__, chart_key(weights, figsize))
+    file = uploaded_charts.get(key)
+    if file is None:
+        png = await render_pie_chart(weights, figsize)
+        file = types.InputFile(BytesIO(png), filename='portfolio_pie_chart.png')
+
+    with metrics.timer('telegram_upload' if isinstance(file, types.InputFile) else 'telegram_send'):
+        sent = await send(file, **kwargs)
+    if sent.document:
+        uploaded_charts.put(key, sent.document.file_id)
+    elif sent.photo:
+        uploaded_charts.put(key, sent.photo[-1].file_id)
+    return sent
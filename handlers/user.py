@@ -1,7 +1,7 @@
-import os
 import json
+import logging
+import time
 import numpy as np
-import matplotlib.pyplot as plt
 import asyncio
 from aiogram import types
 from aiogram.dispatcher import FSMContext
@@ -11,9 +11,14 @@ from aiogram.dispatcher.filters import Text
 from loader import bot, dp
 from keyboards.user_kb import (
     risk_level_keyboard, optimization_param_keyboard, main_inkb,
-    cancel_inkb, yes_no_keyboard, liquidity_param_keyboard)
+    yes_no_keyboard, liquidity_param_keyboard)
 from database.database import user_db
+from handlers import charts
 from model import model
+from model.frontier import TargetReturnError
+from model.jobs import job_queue, DuplicateJob, QueueFull
+from model.simulation import format_simulation
+from metrics import metrics
 
 risk_stats = {'low_risk': 0.05,
               'medium_risk': 0.12,
@@ -115,15 +120,62 @@ async def input_return(message: types.Message, state: FSMContext):
 
 @dp.callback_query_handler(state=PortfolioStates.PORTFOLIO_ASSEMBLED)
 async def assemble_optimized_portfolio(message: types.Message, state: FSMContext):
+    started = time.perf_counter()
+    if isinstance(message, types.CallbackQuery):
+        # Повторное нажатие кнопки, пока портфель считается
+        message = message.message
+
     async with state.proxy() as data:
         optimization_param = data.get('optimization_param')
-        target_risk = data.get('risk')
+        target_risk = data.get('target_risk')
         target_return = data.get('target_return')
         liquidity_metric = data.get(
             'liquidity_metric') or 'Average Trading Volume'
-
-    portfolio_stats, returns = await model.model(optimization_goal=optimization_param, target_risk=target_risk,
-                                                 target_return=target_return, liquidity_metric=liquidity_metric)
+    params = dict(optimization_goal=optimization_param, target_risk=target_risk,
+                  target_return=target_return, liquidity_metric=liquidity_metric)
+
+    status = None
+    result = model.peek(**params)
+    if result is None:
+        try:
+            job = job_queue.submit(message.chat.id, model.model, **params)
+        except DuplicateJob:
+            await message.answer("Ваш портфель уже рассчитывается, пожалуйста, подождите.")
+            return
+        except QueueFull:
+            await message.answer("Сейчас слишком много запросов, попробуйте через пару минут.",
+                                 reply_markup=main_inkb)
+            await state.finish()
+            return
+        status = await message.answer(f"Рассчитываю портфель, вы №{job.position} в очереди...")
+
+    status_text = "Расчёт портфеля завершён."
+    try:
+        if result is None:
+            with metrics.timer('portfolio_wait'):
+                result = await job.future
+    except TargetReturnError as e:
+        await message.answer(f"Такая доходность недостижима: максимально возможная - {e.max_return * 100:.2f}%. "
+                             "Введите значение доходности в процентах:")
+        await PortfolioStates.RETURN_INPUT.set()
+        return
+    except asyncio.TimeoutError:
+        status_text = "Расчёт портфеля прерван."
+        await message.answer("Расчёт портфеля занял слишком много времени, попробуйте позже.",
+                             reply_markup=main_inkb)
+        await state.finish()
+        return
+    except Exception:
+        # Ошибка решателя, пула процессов или брокера: пользователь не должен остаться без ответа
+        logging.exception(f"Portfolio job failed for {params}")
+        status_text = "Не удалось рассчитать портфель."
+        await message.answer("Не удалось рассчитать портфель, попробуйте позже.", reply_markup=main_inkb)
+        await state.finish()
+        return
+    finally:
+        if status is not None:
+            await status.edit_text(status_text)
+    portfolio_stats, returns = result
 
     weights = portfolio_stats['weights']
     expected_return = portfolio_stats['expected_return']
@@ -138,23 +190,14 @@ async def assemble_optimized_portfolio(message: types.Message, state: FSMContext
         + f"Ожидаемая волатильность: {expected_volatility * 100:.2f}%\n"
         + f"Коэффициент Шарпа: {sharpe_ratio:.2f}"
     )
+    if portfolio_stats.get('simulation'):
+        response += "\n\n" + format_simulation(portfolio_stats['simulation'])
 
-    fig, ax = plt.subplots(figsize=(15, 13))
-    assets = weights
-    labels = assets.keys()
-    sizes = assets.values()
-
-    ax.pie(sizes, labels=labels, autopct='%1.1f%%')
-    ax.axis('equal')
-
-    graph_path = f'portfolio_pie_chart{message.from_user.id}.png'
-    plt.savefig(graph_path)
-
-    with open(graph_path, 'rb') as photo:
-        await message.answer_document(photo, caption=f"Ваш портфель по долям активов: {response}",
-                                      reply_markup=main_inkb)
+    await charts.send_pie_chart(message.answer_document, weights,
+                                caption=f"Ваш портфель по долям активов: {response}",
+                                reply_markup=main_inkb)
+    metrics.observe('portfolio_reply', time.perf_counter() - started)
 
-    os.remove(graph_path)
     # await bot.delete_message(message.from_user.id, message.message_id)
     await state.finish()
 
@@ -171,21 +214,9 @@ async def check_portfolio(callback_query: types.CallbackQuery, state: FSMContext
         portfolio = await user_db.get_portfolio(user_id)
         portfolio_str = portfolio[0]
 
-        fig, ax = plt.subplots()
         assets = json.loads(portfolio_str)
-        labels = assets.keys()
-        sizes = assets.values()
-
-        ax.pie(sizes, labels=labels, autopct='%1.1f%%')
-        ax.axis('equal')
-
-        graph_path = 'portfolio_pie_chart.png'
-        plt.savefig(graph_path)
-
-        with open(graph_path, 'rb') as photo:
-            await bot.send_photo(callback_query.from_user.id, photo, caption="Ваш портфель по долям активов:")
-
-        os.remove(graph_path)
+        await charts.send_pie_chart(callback_query.message.answer_photo, assets, figsize=None,
+                                    caption="Ваш портфель по долям активов:")
 
         # Завершаем состояние после выдачи портфеля
         await state.finish()
@@ -1,14 +1,9 @@
-from os import getenv
-
 from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from dotenv import load_dotenv
 
-load_dotenv()
-API_TOKEN = getenv("API_TOKEN")
-ADMIN_ID = getenv("ADMIN_ID")
+from config import API_TOKEN, ADMIN_ID
+from database.fsm_storage import SQLiteStorage
 
-storage = MemoryStorage()
+storage = SQLiteStorage()
 
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher(bot, storage=storage)
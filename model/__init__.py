@@ -1,2 +1 @@
-from . import moex
 from . import model
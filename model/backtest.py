@@ -0,0 +1,218 @@
+import asyncio
+import logging
+
+import numpy as np
+
+from config import BACKTEST_WINDOW, BACKTEST_REBALANCE, BACKTEST_SHRINKAGE, COMPUTE_WORKERS, LIQUIDITY_WINDOW
+from database.database import moex_db
+from database.universe import get_universe
+from metrics import metrics
+from model.compute import compute_service
+from model.liquidity import compute_liquidity_metrics, liquidity_levels
+from model.model import (adjust_cov_matrix_for_liquidity, black_litterman_inputs, compute_mu_market,
+                         optimize_within_risk)
+
+TRADING_DAYS = 252
+# Метрика ликвидности цели 'risk', для которой бот предлагает уровни риска
+LIQUIDITY_METRIC = 'Average Trading Volume'
+
+# версия данных -> {уровень риска: показатели}
+_backtests = {}
+
+
+def daily_returns(close_prices):
+    """
+    Simple daily returns with 0 before a fund's first price, and the index of that first price.
+
+    :param close_prices: pd.DataFrame, forward-filled close prices, dates x ISINs
+    :return: tuple, np.array of returns (days - 1, n) and np.array of first valid day per fund
+    """
+    close = close_prices.to_numpy(dtype=float)
+    listed = np.where(np.isnan(close).all(axis=0), len(close), np.argmax(~np.isnan(close), axis=0))
+    with np.errstate(invalid='ignore'):
+        returns = close[1:] / close[:-1] - 1
+    return np.nan_to_num(returns), listed
+
+
+def rebalance_days(num_days, window=BACKTEST_WINDOW, step=BACKTEST_REBALANCE):
+    """Indices of the return rows on which the portfolio is rebalanced."""
+    return np.arange(window, num_days, step)
+
+
+def rolling_estimates(returns, days, window=BACKTEST_WINDOW, shrinkage=BACKTEST_SHRINKAGE):
+    """
+    Annualized shrunk covariance of the `window` returns before each day.
+
+    The sums of returns and of their outer products are slid from one day to
+    the next, so each step costs O(step * n^2) instead of a full re-estimate.
+
+    :param returns: np.array, daily returns (days, n)
+    :param days: np.array, increasing row indices, each at least `window`
+    :param window: int, estimation window in days
+    :param shrinkage: float, weight of the diagonal target in the covariance
+    :return: np.array, covariances (k, n, n)
+    """
+    n = returns.shape[1]
+    covs = np.empty((len(days), n, n))
+
+    block = returns[days[0] - window:days[0]]
+    total = block.sum(axis=0)
+    cross = block.T @ block
+    previous = days[0]
+    for k, day in enumerate(days):
+        if day != previous:
+            added = returns[previous:day]
+            dropped = returns[previous - window:day - window]
+            total += added.sum(axis=0) - dropped.sum(axis=0)
+            cross += added.T @ added - dropped.T @ dropped
+            previous = day
+
+        mean = total / window
+        cov = (cross - window * np.outer(mean, mean)) / (window - 1)
+        # Сжатие к диагонали, как упрощённый аналог Ledoit-Wolf с фиксированной интенсивностью
+        cov = (1 - shrinkage) * cov + shrinkage * np.diag(np.diag(cov))
+        covs[k] = cov * TRADING_DAYS
+    return covs
+
+
+def backtest_weights(data_version, days, target_risks, window=BACKTEST_WINDOW):
+    """
+    Re-optimize the portfolio on the given rebalance days; runs inside a compute worker.
+
+    Each day goes through the live 'risk' optimizer: the window's
+    covariance with the illiquidity penalty of LIQUIDITY_METRIC, the
+    Black-Litterman posterior of black_litterman_inputs (market weights from
+    NAV, equal views) and the highest return within the risk level. Only
+    what was known on that day is used, so liquidity is measured on the
+    candles before it; the trades store has no history and is left out.
+    Funds without a full window of prices are left out on that day.
+
+    :param data_version: int, price data version
+    :param days: list of int, rebalance row indices
+    :param target_risks: list of float, annual volatility limits
+    :return: np.array, weights (risk levels, days, n)
+    """
+    open_prices, close_prices, volumes = moex_db.get_panels(data_version)
+    returns, listed = daily_returns(close_prices)
+    nav = np.nan_to_num(get_universe().align(close_prices.columns).nav)
+    days = np.asarray(days)
+
+    with metrics.timer('backtest_estimates'):
+        covs = rolling_estimates(returns, days, window)
+
+    weights = np.zeros((len(target_risks), len(days), returns.shape[1]))
+    with metrics.timer('backtest_solve'):
+        for k, day in enumerate(days):
+            valid = np.flatnonzero(listed <= day - window)
+            if len(valid) == 0:
+                continue
+            cov = covs[k][np.ix_(valid, valid)]
+            market = nav[valid] / nav[valid].sum() if nav[valid].sum() > 0 else np.full(len(valid), 1 / len(valid))
+            # Строка доходностей day начинается с цены закрытия строки day
+            known = slice(max(day + 1 - LIQUIDITY_WINDOW, 0), day + 1)
+            levels = liquidity_levels(compute_liquidity_metrics(
+                close_prices.iloc[known, valid], volumes.iloc[known, valid], nav[valid]))
+            artifacts = {
+                'mu_market': compute_mu_market(cov, market, delta=2.5),
+                'liquidity_cov': {LIQUIDITY_METRIC: adjust_cov_matrix_for_liquidity(
+                    cov, LIQUIDITY_METRIC, levels[LIQUIDITY_METRIC])},
+            }
+            mu, adjusted_cov = black_litterman_inputs(artifacts, LIQUIDITY_METRIC, len(valid))
+            for r, target_risk in enumerate(target_risks):
+                weights[r, k, valid] = optimize_within_risk(mu, adjusted_cov, target_risk)
+    return weights
+
+
+def evaluate_paths(returns, days, weights):
+    """
+    Value paths of buy-and-hold portfolios rebalanced on `days`, for all risk levels at once.
+
+    :param returns: np.array, daily returns (T, n)
+    :param days: np.array, rebalance row indices, weights[:, j] is held from days[j] until days[j + 1]
+    :param weights: np.array, (risk levels, k, n)
+    :return: tuple of np.array, value paths (risk levels, days), drawdown paths and turnover per rebalance
+    """
+    period = returns[days[0]:]
+    growth = np.vstack([np.ones(period.shape[1]), np.cumprod(1 + period, axis=0)])
+    starts = days - days[0]
+    ends = np.append(starts[1:], len(period))
+
+    # Номер периода удержания для каждого дня
+    segment = np.repeat(np.arange(len(starts)), ends - starts)
+    relative = (weights[:, segment] * growth[1:] / growth[starts[segment]]).sum(axis=-1)
+    segment_growth = relative[:, ends - 1]
+    segment_start = np.cumprod(np.hstack([np.ones((len(weights), 1)), segment_growth[:, :-1]]), axis=1)
+    value = segment_start[:, segment] * relative
+
+    drawdown = value / np.maximum.accumulate(value, axis=1) - 1
+
+    # Веса к концу периода, после дрейфа цен, против новых весов
+    drifted = weights[:, :-1] * growth[ends[:-1]] / growth[starts[:-1]]
+    drifted /= np.maximum(drifted.sum(axis=-1, keepdims=True), 1e-12)
+    turnover = 0.5 * np.abs(weights[:, 1:] - drifted).sum(axis=-1)
+    return value, drawdown, turnover
+
+
+def summarize(value, drawdown, turnover):
+    years = value.shape[1] / TRADING_DAYS
+    daily = np.diff(np.hstack([np.ones((len(value), 1)), value]), axis=1) / \
+        np.hstack([np.ones((len(value), 1)), value[:, :-1]])
+    return [{
+        'cumulative_return': float(value[r, -1] - 1),
+        'annual_return': float(value[r, -1] ** (1 / years) - 1),
+        'annual_volatility': float(daily[r].std() * np.sqrt(TRADING_DAYS)),
+        'max_drawdown': float(drawdown[r].min()),
+        'annual_turnover': float(turnover[r].sum() / years),
+        'rebalances': turnover.shape[1] + 1,
+        'years': round(years, 2),
+    } for r in range(len(value))]
+
+
+def evaluate_backtest(data_version, days, weights):
+    """Path statistics per risk level; runs inside a compute worker."""
+    open_prices, close_prices, volumes = moex_db.get_panels(data_version)
+    returns, listed = daily_returns(close_prices)
+    with metrics.timer('backtest_paths'):
+        return summarize(*evaluate_paths(returns, np.asarray(days), weights))
+
+
+async def run_backtest(data_version, risk_levels, workers=COMPUTE_WORKERS):
+    """
+    Backtest the optimizer for every risk level, with rebalance days split across compute workers.
+
+    :param data_version: int, price data version
+    :param risk_levels: dict, risk level name -> annual volatility limit
+    :return: dict, risk level name -> statistics, or None if history is too short
+    """
+    # Панели читают воркеры, боту нужна только их длина
+    days = rebalance_days(moex_db.count_dates() - 1)
+    if len(days) < 2:
+        return None
+
+    target_risks = list(risk_levels.values())
+    chunks = [chunk.tolist() for chunk in np.array_split(days, min(workers, len(days)))]
+    parts = await asyncio.gather(*(compute_service.run(backtest_weights, data_version, chunk, target_risks)
+                                   for chunk in chunks))
+    weights = np.concatenate(parts, axis=1)
+    stats = await compute_service.run(evaluate_backtest, data_version, days.tolist(), weights)
+
+    report = dict(zip(risk_levels, stats))
+    # Бэктест устаревшей версии, закончившийся позже, не заменяет текущий отчёт
+    if data_version == moex_db.data_version:
+        _backtests.clear()
+        _backtests[data_version] = report
+    return report
+
+
+async def refresh_backtest(data_version, risk_levels):
+    """Refresh listener: recompute the backtest for a new data version."""
+    try:
+        with metrics.timer('backtest'):
+            await run_backtest(data_version, risk_levels)
+    except Exception:
+        logging.exception("Backtest failed")
+
+
+def latest_backtest():
+    """Most recent backtest report, or None."""
+    return next(iter(_backtests.values()), None)
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+
+from config import RESULT_CACHE_SIZE, TARGET_RETURN_STEP
+from metrics import metrics
+
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class PortfolioCache(LRUCache):
+    """
+    LRU cache of optimization results.
+
+    Keys are (data version, goal, target risk, liquidity metric, target return),
+    with the target return rounded to return_step so that nearby inputs share
+    one entry. Each goal keeps only the target it is optimized for: the
+    target risk for 'risk' and 'liquidity', the target return for 'return'.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, return_step=TARGET_RETURN_STEP):
+        super().__init__(maxsize)
+        self.return_step = return_step
+
+    def round_return(self, target_return):
+        if target_return is None:
+            return None
+        return round(round(target_return / self.return_step) * self.return_step, 6)
+
+    def make_key(self, data_version, optimization_goal, target_risk, liquidity_metric, target_return):
+        if optimization_goal == 'return':
+            target_risk = None
+        else:
+            target_return = None
+        return (data_version, optimization_goal, target_risk, liquidity_metric,
+                self.round_return(target_return))
+
+    def discard_stale(self, data_version):
+        for key in [key for key in self.entries if key[0] != data_version]:
+            del self.entries[key]
+
+
+portfolio_cache = PortfolioCache()
+metrics.track_cache('portfolios', portfolio_cache)
@@ -0,0 +1,39 @@
+import asyncio
+
+from metrics import metrics
+
+
+class SingleFlight:
+    """
+    Shares one in-flight computation between concurrent callers with the same key.
+
+    The shared task is shielded, so a caller that is cancelled does not
+    cancel the work the other callers are waiting for. calls counts all
+    requests, coalesced those that joined an existing computation.
+    """
+
+    def __init__(self):
+        self.inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def _done(self, key, future):
+        self.inflight.pop(key, None)
+        if not future.cancelled():
+            future.exception()  # не даём asyncio ругаться на необработанную ошибку
+
+    async def run(self, key, coro_fn, *args, **kwargs):
+        self.calls += 1
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_fn(*args, **kwargs))
+            self.inflight[key] = future
+            future.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+
+single_flight = SingleFlight()
+metrics.gauge('coalesced_calls_total', lambda: single_flight.coalesced,
+              'Portfolio requests that joined an identical in-flight computation', kind='counter')
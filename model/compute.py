@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import pickle
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from config import (COMPUTE_WORKERS, COMPUTE_MAX_JOBS, COMPUTE_TIMEOUT, COMPUTE_BACKEND, BROKER_POLL_INTERVAL,
+                    BROKER_POLL_MAX, BROKER_LEASE)
+from metrics import metrics
+
+
+def warm_up():
+    """Import the optimizer stack once per worker instead of on its first job."""
+    import cvxpy  # noqa: F401
+    import pypfopt.efficient_frontier  # noqa: F401
+    from model import model  # noqa: F401
+
+
+def ping():
+    return True
+
+
+def instrumented(fn, *args, **kwargs):
+    """Run fn in a worker and return its result with the stage timings recorded so far."""
+    # Замеры упавших задач уходят вместе со следующим успешным результатом
+    return fn(*args, **kwargs), metrics.drain()
+
+
+class ComputeService:
+    """
+    Runs CPU-bound jobs in a process pool so the event loop keeps serving updates.
+
+    At most max_jobs jobs are submitted at once, the rest wait for a slot.
+    A job that does not get a slot and finish in timeout seconds raises
+    asyncio.TimeoutError for the caller. A timed-out job cannot be stopped
+    inside its worker, so the pool is replaced and its processes are
+    terminated. A pool whose worker died (OOM, crash in the solver) is
+    replaced as well, and the jobs it lost are run once more in the new one.
+    """
+
+    def __init__(self, workers=COMPUTE_WORKERS, max_jobs=COMPUTE_MAX_JOBS, timeout=COMPUTE_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_jobs)
+        self.executor = None
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=warm_up)
+            # Процессы создаются по требованию, поэтому запускаем их сразу
+            for _ in range(self.workers):
+                self.executor.submit(ping)
+        return self.executor
+
+    def restart(self, executor):
+        """
+        Replace a broken pool, or one stuck in a timed-out job, with a new one.
+
+        The old pool's processes are terminated, so the jobs still running
+        there fail with BrokenProcessPool and give back their slots.
+
+        :param executor: the pool to replace; nothing is done if it has already been replaced
+        """
+        if executor is not self.executor:
+            return
+        self.executor = None
+        processes = list((executor._processes or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        self.start()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _release(self, future):
+        self.semaphore.release()
+        if not future.cancelled():
+            future.exception()  # ошибка брошенного по таймауту задания не должна попадать в лог asyncio
+
+    async def run(self, fn, *args, **kwargs):
+        deadline = asyncio.get_running_loop().time() + self.timeout
+        try:
+            try:
+                return await self._run(deadline, fn, args, kwargs)
+            except BrokenProcessPool:
+                # Задание могло погибнуть вместе с чужим зависшим или упавшим процессом
+                logging.warning(f"{fn.__name__}{args} lost its worker, retrying in a new pool")
+                return await self._run(deadline, fn, args, kwargs)
+        except asyncio.TimeoutError:
+            logging.warning(f"{fn.__name__}{args} timed out after {self.timeout}s")
+            raise
+
+    async def _run(self, deadline, fn, args, kwargs):
+        loop = asyncio.get_running_loop()
+        # Ожидание слота входит в тот же срок, что и сам расчёт
+        await asyncio.wait_for(self.semaphore.acquire(), max(deadline - loop.time(), 0))
+        try:
+            executor = self.start()
+            future = loop.run_in_executor(executor, partial(instrumented, fn, *args, **kwargs))
+        except BrokenProcessPool:
+            self.semaphore.release()
+            self.restart(executor)
+            raise
+        except BaseException:
+            self.semaphore.release()
+            raise
+        # Слот занят, пока задание выполняется в пуле, даже если вызывающий перестал его ждать
+        future.add_done_callback(self._release)
+        try:
+            with metrics.timer('compute'):
+                result, timings = await asyncio.wait_for(asyncio.shield(future), max(deadline - loop.time(), 0))
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            self.restart(executor)
+            raise
+        metrics.merge(timings)
+        return result
+
+
+def dump_exception(error):
+    try:
+        return pickle.dumps(error)
+    except Exception:
+        # Исключение с непереносимыми аргументами передаётся текстом
+        return pickle.dumps(RuntimeError(repr(error)))
+
+
+class BrokerComputeService:
+    """
+    Runs CPU-bound jobs in standalone worker processes through the SQLite job broker.
+
+    Same interface as ComputeService, for COMPUTE_BACKEND=broker: run()
+    queues the pickled call and waits for its row to be finished by one of
+    the processes started with worker.py, which can run on as many cores
+    as needed independently of the single polling bot. One task polls the
+    broker for all waiting calls and resolves their futures by job id; the
+    poll interval grows up to poll_max while nothing finishes. Broker calls
+    go through one dedicated thread, so a locked database never blocks the
+    event loop. A call that does not finish in timeout seconds raises
+    asyncio.TimeoutError and its job is dropped from the broker.
+    """
+
+    def __init__(self, max_jobs=COMPUTE_MAX_JOBS, timeout=COMPUTE_TIMEOUT, poll_interval=BROKER_POLL_INTERVAL,
+                 poll_max=BROKER_POLL_MAX):
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.poll_max = poll_max
+        self.semaphore = asyncio.Semaphore(max_jobs)
+        self.broker = None
+        self.executor = None
+        self.futures = {}
+        self.poller = None
+        self.wake = None
+        self.job_counts = {}
+
+    def start(self):
+        if self.broker is not None:
+            return
+        from database.broker import JobBroker
+
+        # Одно соединение и один поток: обращения к брокеру выполняются по очереди
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='broker')
+        self.broker = JobBroker()
+        # Задания прошлого запуска бота уже никто не ждёт
+        self.broker.clear()
+
+    def shutdown(self):
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
+        if self.broker is not None:
+            self.executor.submit(self.broker.close)
+            self.executor.shutdown(wait=False)
+            self.broker = None
+            self.executor = None
+
+    def _collect(self, job_ids):
+        # Счётчики для метрик читаются здесь же, чтобы соединение не использовалось из двух потоков
+        return self.broker.collect(job_ids), self.broker.counts()
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _poll(self):
+        interval = self.poll_interval
+        while self.futures:
+            woken = False
+            try:
+                await asyncio.wait_for(self.wake.wait(), interval)
+                woken = True
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                rows, self.job_counts = await self._call(self._collect, list(self.futures))
+            except Exception:
+                # Например, database is locked: ожидающие вызовы дождутся следующего опроса
+                logging.exception("Broker poll failed")
+                interval = self.poll_max
+                continue
+            # Новое или завершённое задание сбрасывает интервал, долгие расчёты опрашиваются всё реже
+            interval = self.poll_interval if rows or woken else min(interval * 2, self.poll_max)
+            for job_id, status, result in rows:
+                future = self.futures.pop(job_id, None)
+                if future is None or future.done():
+                    continue
+                if status == 'done':
+                    future.set_result(pickle.loads(result))
+                else:
+                    future.set_exception(pickle.loads(result))
+
+    async def run(self, fn, *args, **kwargs):
+        self.start()
+        async with self.semaphore:
+            job_id = await self._call(self.broker.submit, pickle.dumps((fn, args, kwargs)))
+            future = self.futures[job_id] = asyncio.get_running_loop().create_future()
+            if self.poller is None or self.poller.done():
+                self.wake = asyncio.Event()
+                self.poller = asyncio.create_task(self._poll())
+            else:
+                self.wake.set()
+            try:
+                with metrics.timer('compute'):
+                    result, timings = await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"{fn.__name__}{args} timed out after {self.timeout}s")
+                raise
+            finally:
+                if self.futures.pop(job_id, None) is not None and self.executor is not None:
+                    # Без ожидания: вызов мог быть отменён
+                    self.executor.submit(self.broker.discard, [job_id])
+            metrics.merge(timings)
+            return result
+
+
+class Heartbeat(threading.Thread):
+    """Renews the broker lease of the worker's current job from its own thread and connection."""
+
+    def __init__(self, worker, interval):
+        super().__init__(name='heartbeat', daemon=True)
+        self.worker = worker
+        self.interval = interval
+        self.job_id = None
+
+    def run(self):
+        from database.broker import JobBroker
+
+        broker = JobBroker()
+        while True:
+            time.sleep(self.interval)
+            job_id = self.job_id
+            if job_id is not None:
+                try:
+                    broker.heartbeat(job_id, self.worker)
+                except Exception:
+                    logging.exception(f"Heartbeat of job {job_id} failed")
+
+
+def serve(poll_interval=BROKER_POLL_INTERVAL, lease=BROKER_LEASE):
+    """Main loop of a worker process: run jobs from the broker until interrupted."""
+    from database.broker import JobBroker
+
+    warm_up()
+    broker = JobBroker(lease=lease)
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    heartbeat = Heartbeat(name, lease / 3)
+    heartbeat.start()
+    logging.info(f"Compute worker {name} started")
+    while True:
+        job = broker.claim(name)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        job_id, payload = job
+        heartbeat.job_id = job_id
+        try:
+            fn, args, kwargs = pickle.loads(payload)
+            status, result = 'done', pickle.dumps(instrumented(fn, *args, **kwargs))
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed")
+            status, result = 'failed', dump_exception(e)
+        finally:
+            heartbeat.job_id = None
+        broker.finish(job_id, name, status, result)
+
+
+if COMPUTE_BACKEND == 'broker':
+    compute_service = BrokerComputeService()
+    metrics.gauge('broker_jobs', lambda: compute_service.job_counts, 'Jobs in the broker by status',
+                  label='status')
+elif COMPUTE_BACKEND == 'pool':
+    compute_service = ComputeService()
+else:
+    raise ValueError("Unknown compute backend: use 'pool' or 'broker'")
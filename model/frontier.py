@@ -0,0 +1,117 @@
+import numpy as np
+
+from config import FRONTIER_POINTS, FRONTIER_TOLERANCE
+
+
+class TargetReturnError(ValueError):
+    """Target return outside of what the long-only frontier can reach."""
+
+    def __init__(self, min_return, max_return):
+        super().__init__(min_return, max_return)
+        self.min_return = min_return
+        self.max_return = max_return
+
+    def __str__(self):
+        return f"Target return must be at most {self.max_return:.4f}"
+
+
+class Frontier:
+    """
+    Efficient frontier sampled at increasing target returns.
+
+    The first point is the minimum volatility portfolio, the last one the
+    maximum return portfolio. Portfolios in between are answered by mixing
+    the two neighbouring points: the mix hits the target return exactly and
+    is feasible, and its volatility is compared against a lower bound of the
+    true frontier to decide whether an exact solve is needed.
+    """
+
+    def __init__(self, mu, cov_matrix, weights, names=None):
+        self.names = names
+        self.mu = np.asarray(mu, dtype=float)
+        self.cov_matrix = np.asarray(cov_matrix, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.returns = self.weights @ self.mu
+        self.volatilities = np.sqrt(
+            np.einsum('ij,jk,ik->i', self.weights, self.cov_matrix, self.weights))
+
+    @property
+    def min_return(self):
+        return self.returns[0]
+
+    @property
+    def max_return(self):
+        return self.returns[-1]
+
+    def volatility(self, weights):
+        return np.sqrt(weights @ self.cov_matrix @ weights)
+
+    def lower_bound(self, lo, hi, target_return):
+        # Граница выпукла, поэтому продолжения соседних хорд лежат не выше неё
+        bounds = []
+        for a, b in ((lo - 1, lo), (hi, hi + 1)):
+            if a >= 0 and b < len(self.returns) and self.returns[b] > self.returns[a]:
+                slope = (self.volatilities[b] - self.volatilities[a]) / \
+                    (self.returns[b] - self.returns[a])
+                bounds.append(self.volatilities[a] +
+                              slope * (target_return - self.returns[a]))
+        return max(bounds) if bounds else None
+
+    def lookup(self, target_return, tolerance=FRONTIER_TOLERANCE):
+        """
+        Weights of the frontier portfolio for target_return.
+
+        :param target_return: float, required annual return
+        :param tolerance: float, allowed excess volatility over the frontier bound
+        :return: np.array of weights, or None if an exact solve is needed
+        :raises TargetReturnError: if target_return is above the maximum return
+        """
+        if target_return > self.max_return + 1e-9:
+            raise TargetReturnError(self.min_return, self.max_return)
+        if target_return <= self.min_return:
+            # efficient_return ниже доходности минимального риска даёт тот же портфель
+            return self.weights[0]
+
+        hi = min(int(np.searchsorted(self.returns, target_return)), len(self.returns) - 1)
+        lo = hi - 1
+        if np.isclose(self.returns[hi], target_return):
+            return self.weights[hi]
+
+        t = (target_return - self.returns[lo]) / (self.returns[hi] - self.returns[lo])
+        weights = (1 - t) * self.weights[lo] + t * self.weights[hi]
+
+        bound = self.lower_bound(lo, hi, target_return)
+        if bound is None or self.volatility(weights) - bound > tolerance:
+            return None
+        return weights
+
+
+def sample_frontier(mu, cov_matrix, points=FRONTIER_POINTS, names=None):
+    """
+    Solve the long-only efficient frontier at evenly spaced target returns.
+
+    :param mu: np.array, expected returns
+    :param cov_matrix: covariance matrix of returns
+    :param points: int, number of frontier portfolios
+    :param names: list, fund names in the order of mu
+    :return: Frontier
+    """
+    from pypfopt.efficient_frontier import EfficientFrontier
+
+    ef = EfficientFrontier(mu, cov_matrix)
+    ef.min_volatility()
+    weights = [ef.weights]
+    min_return = ef.weights @ np.asarray(mu)
+
+    max_weights = np.zeros(len(mu))
+    max_weights[np.argmax(mu)] = 1
+    max_return = np.max(mu)
+
+    if max_return > min_return:
+        for target_return in np.linspace(min_return, max_return, points)[1:-1]:
+            ef = EfficientFrontier(mu, cov_matrix)
+            ef.efficient_return(target_return=target_return)
+            weights.append(ef.weights)
+        weights.append(max_weights)
+
+    return Frontier(mu, cov_matrix, weights, names)
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+from config import QUEUE_WORKERS, QUEUE_MAX_DEPTH
+from metrics import metrics
+
+
+class QueueFull(Exception):
+    """The job queue has reached its maximum depth."""
+
+
+class DuplicateJob(Exception):
+    """The user already has a job waiting or running."""
+
+
+class Job:
+    def __init__(self, user_id, coro_fn, args, kwargs):
+        self.user_id = user_id
+        self.coro_fn = coro_fn
+        self.args = args
+        self.kwargs = kwargs
+        self.position = None
+        self.submitted = time.perf_counter()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class JobQueue:
+    """
+    Bounded FIFO queue of heavy jobs served by a fixed number of workers.
+
+    Every user can have one job waiting or running at a time. Submitting
+    beyond max_depth waiting jobs raises QueueFull instead of letting all
+    jobs slow down together.
+    """
+
+    def __init__(self, workers=QUEUE_WORKERS, max_depth=QUEUE_MAX_DEPTH):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.queue = None
+        self.pending = {}
+        self.tasks = []
+        self.rejected = 0
+
+    @property
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def start(self):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue(self.max_depth)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, user_id, coro_fn, *args, **kwargs):
+        """
+        Enqueue coro_fn(*args, **kwargs) for user_id.
+
+        :return: Job, whose position is its place in the queue and whose
+            future resolves to the result
+        :raises DuplicateJob: if the user already has a pending job
+        :raises QueueFull: if max_depth jobs are already waiting
+        """
+        self.start()
+        if user_id in self.pending:
+            raise DuplicateJob(user_id)
+
+        job = Job(user_id, coro_fn, args, kwargs)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFull(self.max_depth)
+        job.position = self.queue.qsize()
+        self.pending[user_id] = job
+        return job
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            metrics.observe('queue_wait', time.perf_counter() - job.submitted)
+            try:
+                result = await job.coro_fn(*job.args, **job.kwargs)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                # Ожидавший обработчик мог быть отменён
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                del self.pending[job.user_id]
+                self.queue.task_done()
+
+    async def join(self):
+        """Wait until every submitted job has finished."""
+        if self.queue is not None:
+            await self.queue.join()
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.queue = None
+
+
+job_queue = JobQueue()
+metrics.gauge('queue_depth', lambda: job_queue.depth, 'Portfolio jobs waiting for a worker')
+metrics.gauge('jobs_pending', lambda: len(job_queue.pending), 'Portfolio jobs waiting or running')
+metrics.gauge('queue_rejected_total', lambda: job_queue.rejected, 'Portfolio jobs rejected by a full queue',
+              kind='counter')
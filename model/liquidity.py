@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from config import TRADES_DB_PATH, LIQUIDITY_WINDOW, LIQUIDITY_POSITION
+from database.universe import get_universe
+
+LIQUIDITY_METRICS = ('Average Trading Volume', 'Turnover Ratio', 'Bid-Ask Spread', 'Time to Sale')
+# Метрики, у которых большее значение означает более ликвидный фонд
+HIGHER_IS_LIQUID = ('Average Trading Volume', 'Turnover Ratio')
+MAX_LEVEL = 10
+
+
+def read_trade_sides(secids, since=None, filename=TRADES_DB_PATH, chunk=500):
+    """
+    Average buy and sell prices of the given securities from the trades store.
+
+    Only the rows of these securities are read, through the (secid, boardid,
+    tradeno) primary key, so the cost does not grow with the rest of the store.
+    Trades before `since` are skipped, so that the spread is measured over
+    the same window as the other liquidity metrics rather than mixing in the
+    price drift of earlier periods.
+
+    :param secids: list of SECIDs, the panel's columns
+    :param since: str, first trade date 'YYYY-MM-DD' (compared with SYSTIME), None for the whole store
+    :param filename: str, path of the trades database (see trades_loader_repo2)
+    :param chunk: int, SECIDs per query, below the SQLite parameter limit
+    :return: pd.DataFrame indexed by SECID with buy and sell columns, empty if there are no trades
+    """
+    secids = list(secids)
+    if not secids or not os.path.exists(filename):
+        return pd.DataFrame(columns=['buy', 'sell'])
+    bound, bound_params = ("AND systime >= ?", [since]) if since is not None else ("", [])
+    connection = sqlite3.connect(filename)
+    rows = []
+    try:
+        for start in range(0, len(secids), chunk):
+            part = secids[start:start + chunk]
+            rows += connection.execute(f"""
+            SELECT secid, buysell, SUM(price * quantity) / SUM(quantity) FROM moex_trades
+            WHERE secid IN ({','.join('?' * len(part))}) AND quantity > 0 {bound}
+            GROUP BY secid, buysell
+            """, [*part, *bound_params]).fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        connection.close()
+    sides = pd.DataFrame(rows, columns=['secid', 'side', 'price'])
+    sides = sides.pivot(index='secid', columns='side', values='price')
+    return sides.rename(columns={'B': 'buy', 'S': 'sell'}).reindex(columns=['buy', 'sell'])
+
+
+def roll_spread(returns):
+    """
+    Roll's relative spread estimate from the first-order autocovariance of returns.
+
+    :param returns: np.array, days x funds daily returns
+    :return: np.array, spread per fund (0 where the autocovariance is positive)
+    """
+    current = returns[1:] - returns[1:].mean(axis=0)
+    previous = returns[:-1] - returns[:-1].mean(axis=0)
+    autocov = (current * previous).sum(axis=0) / max(len(current) - 1, 1)
+    return 2 * np.sqrt(np.maximum(-autocov, 0))
+
+
+def compute_liquidity_metrics(close_prices, volumes, nav=None, trade_sides=None,
+                              window=LIQUIDITY_WINDOW, position=LIQUIDITY_POSITION):
+    """
+    All liquidity metrics for every fund in one pass over the last `window` days.
+
+    Average Trading Volume is the mean daily traded value in rubles, Turnover
+    Ratio that value as a share of the fund's NAV, Bid-Ask Spread the relative
+    spread between average buy and sell prices from trades (Roll's estimate
+    from close prices where there are no trades) and Time to Sale the number
+    of days needed to sell `position` rubles at the median turnover of a
+    trading day, stretched by the share of days without trades.
+
+    :param close_prices: pd.DataFrame, close prices, dates x ISINs
+    :param volumes: pd.DataFrame, traded volume in units, 0 on days without trades
+    :param nav: np.array, NAV per fund in column order, optional
+    :param trade_sides: pd.DataFrame from read_trade_sides, optional
+    :param window: int, number of recent days to use
+    :param position: float, position size in rubles for Time to Sale
+    :return: pd.DataFrame, metrics x ISINs
+    """
+    close = close_prices.to_numpy(dtype=float)[-window:]
+    volume = np.nan_to_num(volumes.reindex(columns=close_prices.columns).to_numpy(dtype=float)[-window:])
+
+    daily_value = volume * np.nan_to_num(close)
+    traded_value = daily_value.mean(axis=0)
+    active = daily_value > 0
+    nav = np.full(close.shape[1], np.nan) if nav is None else np.asarray(nav, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        # Фонды без сделок в окне дают пустой срез для медианы
+        warnings.simplefilter('ignore', RuntimeWarning)
+        turnover = traded_value / nav
+        # Продажа по типичному обороту торгового дня, с поправкой на дни без сделок
+        typical_value = np.nanmedian(np.where(active, daily_value, np.nan), axis=0)
+        time_to_sale = position / typical_value / active.mean(axis=0)
+        spread = roll_spread(np.diff(np.log(close), axis=0))
+
+    if trade_sides is not None and len(trade_sides):
+        sides = trade_sides.reindex(close_prices.columns).to_numpy(dtype=float)
+        buy, sell = sides[:, 0], sides[:, 1]
+        quoted = np.abs(buy - sell) / ((buy + sell) / 2)
+        spread = np.where(np.isfinite(quoted), quoted, spread)
+
+    return pd.DataFrame([traded_value, turnover, spread, time_to_sale],
+                        index=list(LIQUIDITY_METRICS), columns=close_prices.columns)
+
+
+def liquidity_levels(metrics):
+    """
+    Illiquidity score of each fund per metric, relative to the average fund.
+
+    A score of 1 is the cross-sectional average, larger is less liquid,
+    capped at MAX_LEVEL. Funds without a usable value get MAX_LEVEL.
+
+    :param metrics: pd.DataFrame from compute_liquidity_metrics
+    :return: dict, metric -> np.array of scores in column order
+    """
+    levels = {}
+    for metric in LIQUIDITY_METRICS:
+        values = metrics.loc[metric].to_numpy(dtype=float)
+        if metric in HIGHER_IS_LIQUID:
+            with np.errstate(divide='ignore'):
+                values = 1 / values
+        values[~np.isfinite(values)] = np.nan
+        average = np.nanmean(values) if np.isfinite(values).any() else np.nan
+        if not np.isfinite(average) or average <= 0:
+            levels[metric] = np.ones(len(values))
+            continue
+        relative = values / average
+        levels[metric] = np.minimum(np.nan_to_num(relative, nan=MAX_LEVEL), MAX_LEVEL)
+    return levels
+
+
+def get_liquidity_levels(close_prices, volumes, window=LIQUIDITY_WINDOW):
+    """Liquidity scores of the panel's funds; NAV comes from the universe registry."""
+    nav = get_universe().align(close_prices.columns).nav
+    # Сделки берутся за то же окно, что и остальные метрики
+    since = close_prices.index[-window].strftime('%Y-%m-%d') if len(close_prices) >= window else None
+    trade_sides = read_trade_sides(close_prices.columns, since)
+    metrics = compute_liquidity_metrics(close_prices, volumes, nav, trade_sides, window=window)
+    return liquidity_levels(metrics)
@@ -1,13 +1,22 @@
-import pandas as pd
 import numpy as np
-import asyncio
-from pypfopt.efficient_frontier import EfficientFrontier
-from pypfopt.expected_returns import mean_historical_return
-from pypfopt.risk_models import CovarianceShrinkage
-from model import moex
+import logging
 from database.database import moex_db
+from database.universe import get_universe
+from model.cache import portfolio_cache
+from model.coalesce import single_flight
+from model.compute import compute_service
+from model.frontier import sample_frontier
+from model.liquidity import LIQUIDITY_METRICS, get_liquidity_levels
+from model.simulation import simulate
+from config import COV_ESTIMATOR, LIQUIDITY_PENALTY, SIMULATION_METHOD
+from metrics import metrics
 
-market = pd.read_excel('etf_market.xlsx')
+RISK_FREE_RATE = 0.02  # как по умолчанию в pypfopt
+
+# (версия данных, оценки) последнего расчёта build_artifacts
+_artifacts = None
+# (версия данных, метрика ликвидности) -> Frontier
+_frontiers = {}
 
 
 def compute_returns(prices):
@@ -17,6 +26,9 @@ def compute_returns(prices):
     :param prices: pd.DataFrame, asset prices with assets in columns and prices in rows
     :return: pd.DataFrame, asset returns
     """
+    # pypfopt и cvxpy импортируются в вычислительных процессах, а не при старте бота
+    from pypfopt.expected_returns import mean_historical_return
+
     returns = mean_historical_return(prices)
     return returns
 
@@ -25,56 +37,57 @@ def compute_cov_matrix(prices):
     """
     Compute the covariance matrix for a given set of asset prices.
 
+    Ledoit-Wolf over the whole history, or with COV_ESTIMATOR=ewm the
+    exponentially weighted estimate kept up to date by moex_db.
+
     :param prices: pd.DataFrame, asset prices with assets in columns and prices in rows
     :return: np.array, covariance matrix of the asset returns
     """
 
-    cov_matrix = CovarianceShrinkage(prices).ledoit_wolf()
-    return cov_matrix
-
+    if COV_ESTIMATOR == 'ewm':
+        return moex_db.ewm_covariance(prices)
+    if COV_ESTIMATOR != 'ledoit_wolf':
+        raise ValueError("Unknown covariance estimator: use 'ledoit_wolf' or 'ewm'")
 
-def compute_liquidity_metrics(volumes, bid_prices, ask_prices):
-    avg_trading_volume = volumes.mean()
-    turnover_ratio = volumes.sum() / len(volumes)
-    bid_ask_spread = (ask_prices - bid_prices).mean()
-    time_to_sale = 1 / volumes.mean()  # Simplified metric
+    from pypfopt.risk_models import CovarianceShrinkage
 
-    liquidity_metrics = {
-        'Average Trading Volume': avg_trading_volume,
-        'Turnover Ratio': turnover_ratio,
-        'Bid-Ask Spread': bid_ask_spread,
-        'Time to Sale': time_to_sale
-    }
-
-    return liquidity_metrics
+    cov_matrix = CovarianceShrinkage(prices).ledoit_wolf()
+    return cov_matrix
 
 
 def adjust_cov_matrix_for_liquidity(cov_matrix, liquidity_metric, liquidity_level):
-    if liquidity_metric == 'Average Trading Volume':
-        adjustment = np.diag(1 / (liquidity_level + 1e-6)
-                             )  # Avoid division by zero
-    elif liquidity_metric == 'Turnover Ratio':
-        adjustment = np.diag(liquidity_level)
-    elif liquidity_metric == 'Bid-Ask Spread':
-        adjustment = np.diag(liquidity_level * 0.01)
-    elif liquidity_metric == 'Time to Sale':
-        adjustment = np.diag(liquidity_level * 0.1)
-    else:
+    """
+    Add an illiquidity penalty to the variance of each fund.
+
+    :param cov_matrix: covariance matrix of returns
+    :param liquidity_metric: str, chosen liquidity metric
+    :param liquidity_level: np.array, illiquidity score per fund, 1 for the average fund (see liquidity_levels)
+    :return: adjusted covariance matrix
+    """
+    if liquidity_metric not in LIQUIDITY_METRICS:
         raise ValueError("Unknown liquidity metric")
 
+    # Штраф соразмерен средней дисперсии, поэтому не зависит от единиц метрики
+    variance = np.mean(np.diag(np.asarray(cov_matrix, dtype=float)))
+    adjustment = np.diag(LIQUIDITY_PENALTY * variance * np.asarray(liquidity_level, dtype=float))
+
     adjusted_cov_matrix = cov_matrix + adjustment
     return adjusted_cov_matrix
 
 
-def compute_mu_black_litterman(mu_market, cov_matrix, P, Q, tau):
+def compute_mu_black_litterman(mu_market, cov_matrix, P, Q, tau, omega=None):
     """
     Computes the adjusted expected returns (mu) using the Black-Litterman model.
 
+    Uses the equivalent form mu = mu_market + tau*S*P' (P*tau*S*P' + omega)^-1 (Q - P*mu_market),
+    so only the k x k view matrix is factored (Cholesky) and no n x n inverse is formed.
+
     :param mu_market: np.array, market expected returns
     :param cov_matrix: np.array, covariance matrix of returns
     :param P: np.array, matrix P for the Black-Litterman model
     :param Q: np.array, matrix Q for the Black-Litterman model
     :param tau: float, uncertainty parameter
+    :param omega: np.array, uncertainty of the views, defaults to P*tau*S*P'
     :return: np.array, adjusted expected returns (mu)
     """
     if P.shape[1] != cov_matrix.shape[0]:
@@ -84,15 +97,55 @@ def compute_mu_black_litterman(mu_market, cov_matrix, P, Q, tau):
     if P.shape[0] != Q.shape[0]:
         raise ValueError("P matrix rows must match Q vector length")
 
-    tau_cov_matrix = tau * cov_matrix
-    omega = np.dot(np.dot(P, tau_cov_matrix), P.T)
-    omega_inv = np.linalg.inv(omega)
+    from scipy.linalg import cho_factor, cho_solve
 
-    part1 = np.linalg.inv(np.linalg.inv(tau_cov_matrix) +
-                          np.dot(np.dot(P.T, omega_inv), P))
-    part2 = np.dot(np.linalg.inv(tau_cov_matrix), mu_market) + \
-        np.dot(np.dot(P.T, omega_inv), Q)
-    mu_adjusted = np.dot(part1, part2)
+    mu_market = np.asarray(mu_market, dtype=float)
+    tau_cov_p = tau * np.asarray(cov_matrix, dtype=float) @ P.T
+    view_cov = P @ tau_cov_p
+    if omega is None:
+        omega = view_cov
+
+    factor = cho_factor(view_cov + omega)
+    mu_adjusted = mu_market + tau_cov_p @ cho_solve(factor, Q - P @ mu_market)
+
+    return mu_adjusted
+
+
+def compute_mu_black_litterman_batch(mu_market, cov_matrix, P, Q, tau, omega=None):
+    """
+    Evaluates many view sets against the same covariance matrix in one vectorized call.
+
+    :param mu_market: np.array, market expected returns, shape (n,)
+    :param cov_matrix: np.array, covariance matrix of returns, shape (n, n)
+    :param P: np.array, stacked view matrices, shape (b, k, n)
+    :param Q: np.array, stacked view vectors, shape (b, k)
+    :param tau: float or np.array of shape (b,), uncertainty parameter per view set
+    :param omega: np.array, stacked view uncertainties (b, k, k), defaults to P*tau*S*P'
+    :return: np.array, adjusted expected returns, shape (b, n)
+    """
+    P = np.asarray(P, dtype=float)
+    Q = np.asarray(Q, dtype=float)
+    if P.ndim != 3 or P.shape[2] != cov_matrix.shape[0]:
+        raise ValueError(
+            "P must be a (b, k, n) stack matching covariance matrix dimensions")
+
+    if Q.shape != P.shape[:2]:
+        raise ValueError("Q must be a (b, k) stack matching P")
+
+    mu_market = np.asarray(mu_market, dtype=float)
+    tau = np.broadcast_to(np.asarray(tau, dtype=float), (len(P),))
+    tau_cov_p = tau[:, None, None] * \
+        (np.asarray(cov_matrix, dtype=float) @ P.transpose(0, 2, 1))
+    view_cov = P @ tau_cov_p
+    if omega is None:
+        omega = view_cov
+
+    # L L' = P*tau*S*P' + omega, затем два треугольных решения
+    chol = np.linalg.cholesky(view_cov + omega)
+    residual = (Q - P @ mu_market)[..., None]
+    solution = np.linalg.solve(chol.transpose(0, 2, 1),
+                               np.linalg.solve(chol, residual))
+    mu_adjusted = mu_market + (tau_cov_p @ solution)[..., 0]
 
     return mu_adjusted
 
@@ -110,72 +163,188 @@ def compute_mu_market(cov_matrix, market_weights, delta):
     return mu_market
 
 
-def black_litterman_optimization(prices, liquidity_metric, optimization_goal='risk', target_return=None, target_risk=None):
+def build_artifacts(prices, volumes=None):
     """
-    Portfolio optimization using the Black-Litterman model with liquidity adjustments and optimization criteria.
+    Compute the estimates that depend only on market data, not on the user's choices.
 
     :param prices: pd.DataFrame, asset prices with assets in columns and prices in rows
-    :param liquidity_metric: str, chosen liquidity metric
-    :param optimization_goal: str, optimization criterion ('risk', 'return', 'liquidity')
-    :param target_return: float, target return (used for return optimization)
-    :param target_risk: float, target risk (used for return optimization)
-    :return: np.array, optimal portfolio weights
+    :param volumes: pd.DataFrame, traded volumes of the same assets; without them
+        every fund is treated as equally liquid
+    :return: dict with returns, cov_matrix, market_weights, mu_market, names,
+        liquidity_levels and liquidity_cov (adjusted covariance matrix for each liquidity metric)
     """
-    tau = 0.05
     returns = compute_returns(prices)
 
-    cov_matrix = compute_cov_matrix(prices)
+    with metrics.timer(COV_ESTIMATOR):
+        cov_matrix = compute_cov_matrix(prices)
 
-    market['market_weights'] = market['СЧА, руб'] / market['СЧА, руб'].sum()
-    market_weights = market['market_weights']
+    # Веса и названия в порядке колонок панели, а не в порядке строк etf_market.xlsx
+    universe = get_universe().align(prices.columns)
+    market_weights = universe.weights
 
     mu_market = compute_mu_market(
         cov_matrix, market_weights=market_weights, delta=2.5)
 
-    num_isins = len(prices.columns)
+    if volumes is not None:
+        with metrics.timer('liquidity'):
+            liquidity_levels = get_liquidity_levels(prices, volumes)
+    else:
+        liquidity_levels = {metric: np.ones(len(prices.columns)) for metric in LIQUIDITY_METRICS}
+
+    liquidity_cov = {metric: adjust_cov_matrix_for_liquidity(cov_matrix, metric, liquidity_levels[metric])
+                     for metric in LIQUIDITY_METRICS}
+
+    return {
+        'returns': returns,
+        'cov_matrix': cov_matrix,
+        'market_weights': market_weights,
+        'mu_market': mu_market,
+        'names': universe.names,
+        'liquidity_levels': liquidity_levels,
+        'liquidity_cov': liquidity_cov,
+    }
+
+
+def get_artifacts(data_version, prices, volumes=None):
+    """
+    Return build_artifacts(prices, volumes), computed once per price data version.
+
+    :param data_version: int, version of the price data in prices
+    :param prices: pd.DataFrame, close prices of that version
+    :param volumes: pd.DataFrame, traded volumes of that version
+    :return: dict, see build_artifacts
+    """
+    global _artifacts
+    cached = _artifacts
+    if cached is not None and cached[0] == data_version:
+        return cached[1]
+    artifacts = build_artifacts(prices, volumes)
+    _artifacts = (data_version, artifacts)
+    return artifacts
+
+
+def black_litterman_inputs(artifacts, liquidity_metric, num_isins):
+    """
+    Liquidity-adjusted covariance and Black-Litterman expected returns for one metric.
+
+    :param artifacts: dict, estimates from build_artifacts
+    :param liquidity_metric: str, chosen liquidity metric
+    :param num_isins: int, number of assets
+    :return: tuple, adjusted expected returns (mu) and adjusted covariance matrix
+    """
+    tau = 0.05
+    if liquidity_metric not in artifacts['liquidity_cov']:
+        raise ValueError("Unknown liquidity metric")
+    mu_market = artifacts['mu_market']
+    adjusted_cov_matrix = artifacts['liquidity_cov'][liquidity_metric]
 
     # Assuming investor_views are equal weights across all assets
     investor_views = np.array([1/num_isins] * num_isins)
     P = np.identity(num_isins)
     Q = investor_views
-    liquidity_levels = np.array([2] * num_isins)  # Example liquidity levels
-
-    adjusted_cov_matrix = adjust_cov_matrix_for_liquidity(
-        cov_matrix, liquidity_metric, liquidity_levels)
 
     mu_adjusted = compute_mu_black_litterman(
         mu_market, adjusted_cov_matrix, P, Q, tau)
+    return mu_adjusted, adjusted_cov_matrix
 
-    # Using PyPortfolioOpt for optimization
-    ef = EfficientFrontier(mu_adjusted, adjusted_cov_matrix)
 
-    if optimization_goal == 'risk':
-        optimal_weights = ef.min_volatility()
-    elif optimization_goal == 'return':
-        if target_return is None:
-            raise ValueError(
-                "Target return must be specified for return optimization")
-        ef.efficient_return(target_return=target_return)
-        optimal_weights = ef.clean_weights()
-    elif optimization_goal == 'liquidity':
-        optimal_weights = ef.min_volatility()
-    else:
-        raise ValueError(
-            "Unknown optimization goal: use 'risk', 'return', or 'liquidity'")
+def portfolio_result(weights, mu, cov_matrix, names):
+    """
+    Portfolio statistics in the form shown to the user.
 
-    cleaned_weights = ef.clean_weights()
-    expected_return = ef.portfolio_performance(target_risk or 0.05)[0]
-    expected_volatility = ef.portfolio_performance(target_risk or 0.05)[1]
-    sharpe_ratio = ef.portfolio_performance(target_risk or 0.05)[2]
+    :param weights: np.array, raw portfolio weights
+    :param mu: np.array, expected returns
+    :param cov_matrix: covariance matrix of returns
+    :param names: list, fund names in the order of weights
+    :return: tuple, portfolio statistics and weights rounded to 3 digits
+    """
+    weights = np.asarray(weights, dtype=float)
+    expected_return = float(weights @ np.asarray(mu, dtype=float))
+    expected_volatility = float(np.sqrt(weights @ np.asarray(cov_matrix, dtype=float) @ weights))
+    sharpe_ratio = (expected_return - RISK_FREE_RATE) / expected_volatility
+
+    # Как в EfficientFrontier.clean_weights
+    cleaned_weights = np.where(np.abs(weights) < 1e-4, 0, weights).round(5)
+    rounded_weights = [round(x, 3) for x in cleaned_weights.tolist()]
 
     # Создание словаря с метриками портфеля
     portfolio_stats = {
-        "weights": dict(zip(market['Название'].to_list(), [round(x, 3) for x in cleaned_weights.values()])),
+        "weights": dict(zip(names, rounded_weights)),
         "expected_return": round(expected_return, 3),
         "expected_volatility": round(expected_volatility, 3),
         "sharpe_ratio": round(sharpe_ratio, 3)
     }
-    return portfolio_stats, [round(x, 3) for x in cleaned_weights.values()]
+    return portfolio_stats, rounded_weights
+
+
+def optimize_within_risk(mu, cov_matrix, target_risk):
+    """
+    Highest-return long-only portfolio within target_risk, or the minimum volatility one.
+
+    :param mu: expected returns
+    :param cov_matrix: covariance matrix of returns
+    :param target_risk: float, annual volatility limit, None for minimum volatility
+    :return: np.array, weights
+    """
+    from pypfopt.efficient_frontier import EfficientFrontier
+    from pypfopt.exceptions import OptimizationError
+
+    if target_risk is not None:
+        try:
+            ef = EfficientFrontier(mu, cov_matrix)
+            ef.efficient_risk(target_volatility=target_risk)
+            return ef.weights
+        except (ValueError, OptimizationError):
+            pass  # риск ниже минимально достижимого
+    ef = EfficientFrontier(mu, cov_matrix)
+    ef.min_volatility()
+    return ef.weights
+
+
+def black_litterman_optimization(prices, liquidity_metric, optimization_goal='risk', target_return=None, target_risk=None,
+                                 artifacts=None, simulation=False):
+    """
+    Portfolio optimization using the Black-Litterman model with liquidity adjustments and optimization criteria.
+
+    :param prices: pd.DataFrame, asset prices with assets in columns and prices in rows
+    :param liquidity_metric: str, chosen liquidity metric
+    :param optimization_goal: str, optimization criterion ('risk', 'return', 'liquidity')
+    :param target_return: float, target return (used for return optimization)
+    :param target_risk: float, annual volatility limit (used for risk and liquidity optimization),
+        None or an unreachable limit gives the minimum volatility portfolio
+    :param artifacts: dict, estimates from build_artifacts for these prices, optional
+    :param simulation: bool, add the Monte Carlo outcome of the optimal weights to the statistics
+    :return: np.array, optimal portfolio weights
+    """
+    if artifacts is None:
+        artifacts = build_artifacts(prices)
+    with metrics.timer('black_litterman'):
+        mu_adjusted, adjusted_cov_matrix = black_litterman_inputs(
+            artifacts, liquidity_metric, len(prices.columns))
+
+    from pypfopt.efficient_frontier import EfficientFrontier
+
+    # Using PyPortfolioOpt for optimization
+    with metrics.timer('solve'):
+        if optimization_goal in ('risk', 'liquidity'):
+            # Риск считается по скорректированной на ликвидность ковариации
+            weights = optimize_within_risk(mu_adjusted, adjusted_cov_matrix, target_risk)
+        elif optimization_goal == 'return':
+            if target_return is None:
+                raise ValueError(
+                    "Target return must be specified for return optimization")
+            ef = EfficientFrontier(mu_adjusted, adjusted_cov_matrix)
+            ef.efficient_return(target_return=target_return)
+            weights = ef.weights
+        else:
+            raise ValueError(
+                "Unknown optimization goal: use 'risk', 'return', or 'liquidity'")
+
+    portfolio_stats, rounded_weights = portfolio_result(weights, mu_adjusted, adjusted_cov_matrix,
+                                                        artifacts['names'])
+    if simulation:
+        portfolio_stats['simulation'] = simulate_weights(weights, mu_adjusted, artifacts, prices)
+    return portfolio_stats, rounded_weights
 
 
 def check_and_clean_data(prices):
@@ -190,25 +359,167 @@ def check_and_clean_data(prices):
     return prices
 
 
-async def model(optimization_goal='risk', target_return=None, target_risk=0.04, liquidity_metric='Average Trading Volume'):
-    open_prices, close_prices, volumes = await moex_db.get_cached_moex_data()
+def optimize_portfolio(data_version, optimization_goal='risk', target_return=None, target_risk=0.04,
+                       liquidity_metric='Average Trading Volume'):
+    """
+    Build the optimal portfolio from the cached prices; runs inside a compute worker.
+
+    :param data_version: int, price data version the request was made for
+    :return: tuple, portfolio statistics and rounded weights
+    """
+    # Панели уже очищены (ffill) и закэшированы до следующего обновления
+    open_prices, close_prices, volumes = moex_db.get_panels(data_version)
+    artifacts = get_artifacts(moex_db.data_version, close_prices, volumes)
 
-    close_prices, open_prices, volumes = [check_and_clean_data(data)
-                                          for data in (close_prices, open_prices, volumes)]
     if optimization_goal == 'risk':
         portfolio_stats, mu_adjusted = black_litterman_optimization(
-            close_prices, liquidity_metric=liquidity_metric, optimization_goal='risk', target_risk=target_risk)
+            close_prices, liquidity_metric=liquidity_metric, optimization_goal='risk', target_risk=target_risk,
+            artifacts=artifacts, simulation=True)
     elif optimization_goal == 'return':
-        print('Тут')
         portfolio_stats, mu_adjusted = black_litterman_optimization(
-            close_prices, liquidity_metric=liquidity_metric, optimization_goal='return', target_return=target_return)
+            close_prices, liquidity_metric=liquidity_metric, optimization_goal='return', target_return=target_return,
+            artifacts=artifacts, simulation=True)
     elif optimization_goal == 'liquidity':
         portfolio_stats, mu_adjusted = black_litterman_optimization(
-            close_prices, liquidity_metric=liquidity_metric, optimization_goal='liquidity')
+            close_prices, liquidity_metric=liquidity_metric, optimization_goal='liquidity', target_risk=target_risk,
+            artifacts=artifacts, simulation=True)
 
     return portfolio_stats, mu_adjusted
 
 
+def simulate_weights(weights, mu, artifacts, prices):
+    """
+    Monte Carlo outcome of the weights over the simulation horizon.
+
+    Returns are drawn around the Black-Litterman expected returns with the
+    market covariance of build_artifacts (Ledoit-Wolf or the EW estimate,
+    see COV_ESTIMATOR): the liquidity penalty steers the optimizer but is
+    not a price risk, so it is left out here.
+
+    :param weights: np.array, raw portfolio weights in column order
+    :param mu: np.array, Black-Litterman expected returns
+    :param artifacts: dict, estimates from build_artifacts for these prices
+    :param prices: pd.DataFrame, close prices, used by the bootstrap method
+    :return: dict, see simulation.simulate
+    """
+    history = None
+    if SIMULATION_METHOD == 'bootstrap':
+        history = prices.pct_change().iloc[1:].fillna(0).to_numpy()
+    with metrics.timer('simulation'):
+        return simulate(weights, mu, artifacts['cov_matrix'], history=history)
+
+
+def simulate_portfolio(data_version, weights, liquidity_metric):
+    """
+    Monte Carlo outcome of given weights, see simulate_weights; runs inside a compute worker.
+
+    :param data_version: int, price data version the request was made for
+    :param weights: np.array, raw portfolio weights in column order
+    :param liquidity_metric: str, chosen liquidity metric
+    :return: dict, see simulation.simulate
+    """
+    open_prices, close_prices, volumes = moex_db.get_panels(data_version)
+    artifacts = get_artifacts(moex_db.data_version, close_prices, volumes)
+    mu_adjusted, adjusted_cov_matrix = black_litterman_inputs(
+        artifacts, liquidity_metric, len(close_prices.columns))
+    return simulate_weights(weights, mu_adjusted, artifacts, close_prices)
+
+
+def build_frontier(data_version, liquidity_metric):
+    """
+    Sample the efficient frontier for one liquidity metric; runs inside a compute worker.
+
+    :param data_version: int, price data version the request was made for
+    :param liquidity_metric: str, chosen liquidity metric
+    :return: Frontier
+    """
+    open_prices, close_prices, volumes = moex_db.get_panels(data_version)
+    artifacts = get_artifacts(moex_db.data_version, close_prices, volumes)
+    mu_adjusted, adjusted_cov_matrix = black_litterman_inputs(
+        artifacts, liquidity_metric, len(close_prices.columns))
+    with metrics.timer('frontier'):
+        return sample_frontier(mu_adjusted, adjusted_cov_matrix, names=artifacts['names'])
+
+
+async def get_frontier(data_version, liquidity_metric):
+    key = (data_version, liquidity_metric)
+    frontier = _frontiers.get(key)
+    if frontier is None:
+        frontier = await single_flight.run(('frontier', *key), compute_service.run,
+                                           build_frontier, data_version, liquidity_metric)
+        # Запоздавший расчёт по устаревшей версии не должен вытеснять текущие границы
+        if data_version == moex_db.data_version:
+            for stale in [stale for stale in _frontiers if stale[0] != data_version]:
+                del _frontiers[stale]
+            _frontiers[key] = frontier
+    return frontier
+
+
+async def solve(data_version, optimization_goal, target_return, target_risk, liquidity_metric):
+    if optimization_goal == 'return' and target_return is not None:
+        # Ответ по сетке границы; недостижимая доходность отклоняется здесь же
+        frontier = await get_frontier(data_version, liquidity_metric)
+        weights = frontier.lookup(target_return)
+        if weights is not None:
+            portfolio_stats, rounded_weights = portfolio_result(weights, frontier.mu, frontier.cov_matrix,
+                                                                frontier.names)
+            portfolio_stats['simulation'] = await compute_service.run(simulate_portfolio, data_version,
+                                                                      weights, liquidity_metric)
+            return portfolio_stats, rounded_weights
+    return await compute_service.run(optimize_portfolio, data_version, optimization_goal=optimization_goal,
+                                     target_return=target_return, target_risk=target_risk,
+                                     liquidity_metric=liquidity_metric)
+
+
+def peek(optimization_goal='risk', target_return=None, target_risk=0.04, liquidity_metric='Average Trading Volume'):
+    """Cached result for these parameters, or None if it has to be computed."""
+    key = portfolio_cache.make_key(moex_db.data_version, optimization_goal, target_risk, liquidity_metric,
+                                   target_return)
+    return portfolio_cache.get(key)
+
+
+async def model(optimization_goal='risk', target_return=None, target_risk=0.04, liquidity_metric='Average Trading Volume'):
+    data_version = moex_db.data_version
+    # Округление только в ключе кэша: решается введённая пользователем доходность
+    key = portfolio_cache.make_key(data_version, optimization_goal, target_risk, liquidity_metric, target_return)
+    result = portfolio_cache.get(key)
+    if result is None:
+        # Одинаковые одновременные запросы ждут один и тот же расчёт
+        result = await single_flight.run(key, solve, data_version, optimization_goal, target_return,
+                                         target_risk, liquidity_metric)
+        portfolio_cache.put(key, result)
+    return result
+
+
+async def warm_up(data_version, target_risks):
+    """
+    Precompute every portfolio reachable through the keyboards for a new data version.
+
+    :param data_version: int, data version that has just been committed
+    :param target_risks: iterable of target risks offered to users
+    """
+    portfolio_cache.discard_stale(data_version)
+    for liquidity_metric in LIQUIDITY_METRICS:
+        if moex_db.data_version != data_version:
+            return
+        try:
+            await get_frontier(data_version, liquidity_metric)
+        except Exception:
+            logging.exception(f"Frontier warm-up failed for {liquidity_metric}")
+
+    combinations = [('risk', 'Average Trading Volume')] + \
+        [('liquidity', metric) for metric in LIQUIDITY_METRICS]
+    for target_risk in target_risks:
+        for optimization_goal, liquidity_metric in combinations:
+            if moex_db.data_version != data_version:
+                return  # пришло более свежее обновление
+            try:
+                await model(optimization_goal=optimization_goal, target_risk=target_risk,
+                            liquidity_metric=liquidity_metric)
+            except Exception:
+                logging.exception(f"Warm-up failed for {optimization_goal}, {target_risk}, {liquidity_metric}")
+
+
 #    Average Trading Volume': avg_trading_volume,
 #    Turnover Ratio': turnover_ratio,
 #    Bid-Ask Spread': bid_ask_spread,
@@ -5,11 +5,10 @@ import aiohttp
 import pandas as pd
 import requests
 import apimoex
+from database.universe import get_universe
 
-# Read the Excel file and get the ISINs
-market = pd.read_excel('etf_market.xlsx')
-df = pd.read_excel('etf_data.xlsx')
-isins = df['Тикер']
+# ISIN фондов из реестра, без повторного разбора Excel
+isins = get_universe().tickers
 etfs = []
 today = datetime.now().date()
 
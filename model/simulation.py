@@ -0,0 +1,85 @@
+import numpy as np
+
+from config import SIMULATION_PATHS, SIMULATION_HORIZON, SIMULATION_METHOD, SIMULATION_MEMORY_MB
+
+TRADING_DAYS = 252
+PERCENTILES = (5, 25, 50, 75, 95)
+SIMULATION_METHODS = ('normal', 'bootstrap')
+
+
+def checkpoint_days(horizon):
+    """Month ends within the horizon plus the horizon itself, in trading days."""
+    return np.unique(np.append(np.arange(21, horizon, 21), horizon))
+
+
+def simulate(weights, mu, cov_matrix, horizon=SIMULATION_HORIZON, paths=SIMULATION_PATHS,
+             method=SIMULATION_METHOD, history=None, memory_mb=SIMULATION_MEMORY_MB, seed=None):
+    """
+    Monte Carlo distribution of the portfolio value over the horizon.
+
+    'normal' draws correlated daily log-returns from N(mu, cov_matrix)
+    through its Cholesky factor, 'bootstrap' resamples historical days.
+    Both draws are projected on the weights before the paths are built,
+    so a path costs one number per day whatever the number of funds, and
+    paths are generated in chunks that fit into memory_mb.
+
+    :param weights: np.array, portfolio weights
+    :param mu: np.array, annual expected returns
+    :param cov_matrix: annual covariance matrix of returns
+    :param horizon: int, horizon in trading days
+    :param paths: int, number of simulated paths
+    :param method: str, 'normal' or 'bootstrap'
+    :param history: np.array, daily simple returns (days, n), required for 'bootstrap'
+    :param memory_mb: float, memory budget of one chunk of paths
+    :param seed: int, random seed, optional
+    :return: dict with checkpoint days, percentiles, bands (percentiles x days)
+        of the value of 1 invested, probability_of_loss and expected_value at the horizon
+    """
+    weights = np.asarray(weights, dtype=float)
+    rng = np.random.default_rng(seed)
+
+    if method == 'normal':
+        cov_matrix = np.asarray(cov_matrix, dtype=float)
+        factor = np.linalg.cholesky(cov_matrix + 1e-12 * np.eye(len(cov_matrix)))
+        # w'Lz ~ N(0, w'Σw): достаточно одной нормальной величины на день
+        scale = np.linalg.norm(factor.T @ weights) / np.sqrt(TRADING_DAYS)
+        drift = weights @ np.asarray(mu, dtype=float) / TRADING_DAYS - scale ** 2 / 2
+
+        def draw(size):
+            return drift + scale * rng.standard_normal(size)
+    elif method == 'bootstrap':
+        if history is None or len(history) == 0:
+            raise ValueError("Bootstrap simulation needs historical returns")
+        portfolio_history = np.log1p(np.asarray(history, dtype=float) @ weights)
+
+        def draw(size):
+            return portfolio_history[rng.integers(len(portfolio_history), size=size)]
+    else:
+        raise ValueError(f"Unknown simulation method: use one of {SIMULATION_METHODS}")
+
+    days = checkpoint_days(horizon)
+    # Черновой массив и накопленная сумма, по 8 байт на день пути
+    chunk = max(1, int(memory_mb * 2 ** 20 // (horizon * 8 * 2)))
+    values = np.empty((paths, len(days)))
+    for start in range(0, paths, chunk):
+        size = min(chunk, paths - start)
+        log_values = np.cumsum(draw((size, horizon)), axis=1)
+        values[start:start + size] = np.exp(log_values[:, days - 1])
+
+    return {
+        'days': days.tolist(),
+        'percentiles': PERCENTILES,
+        'bands': np.percentile(values, PERCENTILES, axis=0),
+        'probability_of_loss': float((values[:, -1] < 1).mean()),
+        'expected_value': float(values[:, -1].mean()),
+    }
+
+
+def format_simulation(simulation):
+    """Horizon outcome in the form shown to the user."""
+    bands = dict(zip(simulation['percentiles'], simulation['bands'][:, -1] - 1))
+    months = round(simulation['days'][-1] / 21)
+    return (f"Моделирование на {months} мес.:\n"
+            f"С вероятностью 90%: от {bands[5] * 100:.1f}% до {bands[95] * 100:.1f}%\n"
+            f"Медиана: {bands[50] * 100:.1f}%\n"
+            f"Вероятность убытка: {simulation['probability_of_loss'] * 100:.1f}%")
@@ -1,82 +1,152 @@
 import asyncio
+import logging
 import pathlib
-import aiohttp
-import aiohttp.client_exceptions
-import aiomoex
-import pandas as pd
-import pathlib
-import requests
+import sqlite3
+from datetime import datetime
+
 import pandas as pd
-from datetime import datetime, timedelta
-from time import sleep
-from tqdm import tqdm
-import concurrent.futures
-import numpy as np
-
-
-async def security_finder(market, board):
-    df = pd.DataFrame()
-    request_url = f"https://iss.moex.com/iss/engines/stock/markets/{market}/boards/{board}/securities.json"
-
-    async with aiohttp.ClientSession() as session:
-        iss = aiomoex.ISSClient(session, request_url)
-        resp = await iss.get()
-        tmp = pd.DataFrame(resp["securities"])
-        tmp.dropna(axis=1, how='all', inplace=True)
-        df = pd.concat([df, tmp], ignore_index=True)
-        # print(df.head(), "\n")
-       # print(df.tail(), "\n")
-        # df.info()
-    df['MARKET'] = iterator['MARKET'][i]
-    return df
-
-
-async def main(iterator):
-    df = pd.DataFrame()
-    flag = 1
-    for i in range(0, len(iterator), 1):
-        request_url = f"https://iss.moex.com/iss/engines/stock/markets/{iterator['MARKET'][i]}/boards/{iterator['BOARDID'][i]}/securities/{iterator['SECID'][i]}/trades.json"
-
-        async with aiohttp.ClientSession() as session:
-            iss = aiomoex.ISSClient(session, request_url)
-            try:
-                resp = await iss.get()
-                flag = 1
-                # print(df.head(), "\n")
-                # print(df.tail(), "\n")
-                # df.info
-            except aiohttp.client_exceptions.ClientConnectionError:
-                flag = 0
-                print(iss._url)
-            if flag:
-                tmp = pd.DataFrame(resp["trades"])
-                tmp.dropna(axis=1, how='all', inplace=True)
-                df = pd.concat([df, tmp], ignore_index=True)
-            ()
-
-    return df
-
-
-till_ = datetime.today().strftime('%Y-%m-%d')
-from_ = (datetime.today() - timedelta(days=2)).strftime('%Y-%m-%d')
-
-p1 = pathlib.Path()
-# p1 =  pathlib.Path(r'C:\python\repo_publisher\trades_data\tmp')
-iterator = pd.read_csv(p1/'adres_boards.csv', sep=';')
-
-data = pd.DataFrame()
-for i in range(0, len(iterator), 1):
-    tmp = asyncio.run(security_finder(
-        iterator['MARKET'][i], iterator['BOARDID'][i]))
-    tmp['MARKET'] = iterator['MARKET'][i]
-    data = pd.concat([data, tmp], ignore_index=True)
-data.to_csv(p1/('security_finder.csv'))
-
-iterator2 = data[['SECID', 'BOARDID', 'MARKET']].drop_duplicates()
-
-data2 = asyncio.run(main(iterator2))
-# data2.to_csv(p1/('trades_data_' + datetime.today().strftime('%Y-%m-%d') +'.csv'))
-data2 = data2.merge(data[['MARKET', 'SECID', 'LOTSIZE', 'SECNAME',
-                    'CURRENCYID', 'BOARDID']], on=['SECID', 'BOARDID'])
-data2.to_csv(
-    p1/('trades_data_' + datetime.today().strftime('%Y-%m-%d, %H-%M-%S') + '.csv'))
+
+from config import TRADES_DB_PATH
+from database.iss import iss_client
+
+# Поля сделок ISS, которые сохраняются в таблицу moex_trades
+TRADE_COLUMNS = ('TRADENO', 'SECID', 'BOARDID', 'TRADETIME', 'SYSTIME', 'PRICE', 'QUANTITY', 'VALUE', 'BUYSELL')
+SECURITY_COLUMNS = ('SECID', 'BOARDID', 'MARKET', 'SECNAME', 'LOTSIZE', 'CURRENCYID')
+
+
+class TradesStore:
+    """
+    Append-only SQLite store of MOEX trades.
+
+    Pages are written as they arrive, so memory use does not depend on the
+    number of trades. The last stored trade number of each security is the
+    point a new run resumes from.
+    """
+
+    def __init__(self, filename=TRADES_DB_PATH):
+        self.base = sqlite3.connect(filename, check_same_thread=False)
+        self.base.execute("PRAGMA journal_mode=WAL")
+        self.base.execute("PRAGMA synchronous=NORMAL")
+        self.create_database()
+
+    def create_database(self):
+        with self.base:
+            self.base.execute("""
+            CREATE TABLE IF NOT EXISTS moex_securities (
+                secid TEXT,
+                boardid TEXT,
+                market TEXT,
+                secname TEXT,
+                lotsize REAL,
+                currencyid TEXT,
+                PRIMARY KEY (secid, boardid)
+            ) WITHOUT ROWID""")
+            self.base.execute("""
+            CREATE TABLE IF NOT EXISTS moex_trades (
+                tradeno INTEGER,
+                secid TEXT,
+                boardid TEXT,
+                tradetime TEXT,
+                systime TEXT,
+                price REAL,
+                quantity REAL,
+                value REAL,
+                buysell TEXT,
+                PRIMARY KEY (secid, boardid, tradeno)
+            ) WITHOUT ROWID""")
+
+    def save_securities(self, rows):
+        with self.base:
+            self.base.executemany("""
+            INSERT OR REPLACE INTO moex_securities (secid, boardid, market, secname, lotsize, currencyid)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, [tuple(row.get(column) for column in SECURITY_COLUMNS) for row in rows])
+
+    def get_securities(self):
+        return self.base.execute("SELECT secid, boardid, market FROM moex_securities").fetchall()
+
+    def save_trades(self, rows):
+        # Повторно полученные сделки (перекрытие при возобновлении) пропускаются
+        with self.base:
+            self.base.executemany("""
+            INSERT OR IGNORE INTO moex_trades (tradeno, secid, boardid, tradetime, systime, price, quantity, value, buysell)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [tuple(row.get(column) for column in TRADE_COLUMNS) for row in rows])
+
+    def last_tradeno(self, secid, boardid):
+        (tradeno,) = self.base.execute(
+            "SELECT MAX(tradeno) FROM moex_trades WHERE secid = ? AND boardid = ?", (secid, boardid)).fetchone()
+        return tradeno
+
+    def export_csv(self, path, chunksize=100_000):
+        """Write trades joined with security attributes to CSV chunk by chunk."""
+        query = """
+        SELECT t.*, s.market, s.secname, s.lotsize, s.currencyid
+        FROM moex_trades t JOIN moex_securities s USING (secid, boardid)
+        ORDER BY t.secid, t.boardid, t.tradeno
+        """
+        header = True
+        for chunk in pd.read_sql_query(query, self.base, chunksize=chunksize):
+            chunk.to_csv(path, mode='w' if header else 'a', header=header, index=False)
+            header = False
+
+    def close(self):
+        self.base.close()
+
+
+async def security_finder(store, market, board):
+    """Load the securities of one board into the store."""
+    path = f"engines/stock/markets/{market}/boards/{board}/securities.json"
+    rows = (await iss_client.get(path, {})).get('securities', [])
+    store.save_securities([{**row, 'MARKET': market} for row in rows])
+    return len(rows)
+
+
+async def load_trades(store, market, board, secid):
+    """
+    Stream the trades of one security into the store, page by page.
+
+    Pages are requested by trade number, starting after the last stored one,
+    so an interrupted run continues where it stopped.
+
+    :return: int, number of new trades
+    """
+    path = f"engines/stock/markets/{market}/boards/{board}/securities/{secid}/trades.json"
+    last = store.last_tradeno(secid, board)
+    loaded = 0
+    while True:
+        query = {} if last is None else {'tradeno': last, 'next_trade': 1}
+        rows = (await iss_client.get(path, query)).get('trades', [])
+        rows = [row for row in rows if last is None or row['TRADENO'] > last]
+        if not rows:
+            return loaded
+        store.save_trades(rows)
+        loaded += len(rows)
+        last = max(row['TRADENO'] for row in rows)
+
+
+async def main(boards_path=pathlib.Path('adres_boards.csv')):
+    store = TradesStore()
+    try:
+        boards = pd.read_csv(boards_path, sep=';')[['MARKET', 'BOARDID']].drop_duplicates()
+        boards = list(boards.itertuples(index=False, name=None))
+        found, failed = await iss_client.get_many(lambda board: security_finder(store, *board), boards)
+        for board, error in failed.items():
+            logging.warning(f"Securities of {board} were not loaded: {error}")
+
+        securities = [(market, boardid, secid) for secid, boardid, market in store.get_securities()]
+        loaded, failed = await iss_client.get_many(lambda security: load_trades(store, *security), securities)
+        for security, error in failed.items():
+            logging.warning(f"Trades of {security} were not loaded: {error}")
+        logging.info(f"Loaded {sum(loaded.values())} trades of {len(loaded)} securities")
+
+        store.export_csv(boards_path.parent / (
+            'trades_data_' + datetime.today().strftime('%Y-%m-%d, %H-%M-%S') + '.csv'))
+    finally:
+        await iss_client.close()
+        store.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
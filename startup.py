@@ -0,0 +1,77 @@
+import builtins
+import importlib.util
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class StartupReport:
+    """
+    Breaks bot startup time down by imported package and init stage.
+
+    While installed, every first import of a module is timed; the time
+    spent in nested imports is subtracted, so each top-level package is
+    charged only for its own modules.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imports = defaultdict(float)
+        self.stages = {}
+        self.finished = None
+        self._stack = []
+        self._original_import = builtins.__import__
+
+    def install(self):
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        builtins.__import__ = self._original_import
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        resolved = name
+        if level:
+            package = (globals or {}).get('__package__') or ''
+            resolved = importlib.util.resolve_name('.' * level + name, package)
+        # Подмодули из `from package import module` тоже могут загружаться впервые
+        if resolved in sys.modules and all(f"{resolved}.{item}" in sys.modules or item == '*'
+                                           or hasattr(sys.modules[resolved], item)
+                                           for item in fromlist or ()):
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.imports[resolved.split('.')[0]] += elapsed - nested
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - start
+
+    def finish(self):
+        self.uninstall()
+        self.finished = time.perf_counter()
+
+    def format(self, top=15):
+        total = (self.finished or time.perf_counter()) - self.started
+        lines = [f"Startup took {total:.3f}s", "Imports:"]
+        for name, seconds in sorted(self.imports.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f"  {name:<24}{seconds:8.3f}s")
+        lines.append("Init stages:")
+        for name, seconds in self.stages.items():
+            lines.append(f"  {name:<24}{seconds:8.3f}s")
+        return "\n".join(lines)
+
+
+startup_report = StartupReport()
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+from config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT,
+                    WEBHOOK_CONCURRENCY, WEBHOOK_DRAIN_TIMEOUT)
+from model.jobs import job_queue
+from metrics import handle_metrics
+
+
+class WebhookServer:
+    """
+    aiohttp server that receives Telegram updates by webhook.
+
+    Every update is acknowledged at once and processed in the background,
+    with at most `concurrency` updates handled at the same time. On
+    shutdown the server stops accepting requests, waits for the updates in
+    progress and the queued portfolio jobs, and only then calls on_shutdown.
+
+    Recorded updates can be replayed locally by POSTing their JSON to
+    WEBHOOK_PATH; without WEBHOOK_URL the webhook is not registered.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, path=WEBHOOK_PATH, concurrency=WEBHOOK_CONCURRENCY,
+                 secret=WEBHOOK_SECRET, drain_timeout=WEBHOOK_DRAIN_TIMEOUT):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.drain_timeout = drain_timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        self.processed = 0
+
+    async def handle_update(self, request: web.Request):
+        if self.secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            raise web.HTTPUnauthorized()
+
+        update = types.Update(**await request.json())
+        task = asyncio.create_task(self.process_update(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def process_update(self, update):
+        async with self.semaphore:
+            Bot.set_current(self.dispatcher.bot)
+            Dispatcher.set_current(self.dispatcher)
+            try:
+                await self.dispatcher.process_update(update)
+            except Exception:
+                logging.exception(f"Failed to process update {update.update_id}")
+            finally:
+                self.processed += 1
+
+    async def health(self, request: web.Request):
+        return web.json_response({
+            'status': 'ok',
+            'updates_in_progress': len(self.tasks),
+            'updates_processed': self.processed,
+            'queue_depth': job_queue.depth,
+        })
+
+    async def drain(self):
+        try:
+            await asyncio.wait_for(self._drain(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Shutdown drain did not finish in {self.drain_timeout}s")
+
+    async def _drain(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await job_queue.join()
+
+    def make_app(self, on_startup, on_shutdown):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/health', self.health)
+        app.router.add_get('/metrics', handle_metrics)
+
+        async def startup(app):
+            if WEBHOOK_URL:
+                await self.dispatcher.bot.set_webhook(WEBHOOK_URL + self.path, secret_token=self.secret)
+            await on_startup(self.dispatcher)
+
+        async def shutdown(app):
+            await self.drain()
+            await on_shutdown(self.dispatcher)
+
+        async def cleanup(app):
+            await self.dispatcher.storage.close()
+            await self.dispatcher.storage.wait_closed()
+            await (await self.dispatcher.bot.get_session()).close()
+
+        app.on_startup.append(startup)
+        app.on_shutdown.append(shutdown)
+        app.on_cleanup.append(cleanup)
+        return app
+
+
+def start_webhook(dispatcher, on_startup, on_shutdown, host=WEBAPP_HOST, port=WEBAPP_PORT):
+    server = WebhookServer(dispatcher)
+    web.run_app(server.make_app(on_startup, on_shutdown), host=host, port=port)
@@ -0,0 +1,58 @@
+"""
+Standalone compute workers for COMPUTE_BACKEND=broker.
+
+The bot queues optimization jobs in the SQLite broker (BROKER_DB_PATH) and
+these processes run them, so CPU can be added without more polling bots:
+
+    python worker.py --processes 4
+
+A process that exits (killed by the OOM killer, crashed in the solver) is
+started again, so the number of workers stays the same.
+"""
+import argparse
+import logging
+import multiprocessing
+import time
+
+from config import COMPUTE_WORKERS
+
+RESPAWN_INTERVAL = 1  # секунды между проверками процессов
+
+
+def run_worker():
+    logging.basicConfig(level=logging.INFO)
+    from model.compute import serve
+
+    try:
+        serve()
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--processes', type=int, default=COMPUTE_WORKERS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    context = multiprocessing.get_context('spawn')
+    processes = [None] * args.processes
+    try:
+        while True:
+            for i, process in enumerate(processes):
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logging.warning(f"{process.name} exited with code {process.exitcode}, restarting")
+                processes[i] = context.Process(target=run_worker, name=f'worker-{i}')
+                processes[i].start()
+            # Не чаще раза в секунду, даже если процесс падает сразу после запуска
+            time.sleep(RESPAWN_INTERVAL)
+    except KeyboardInterrupt:
+        for process in processes:
+            if process is not None:
+                process.join()
+
+
+if __name__ == '__main__':
+    main()